@@ -0,0 +1,202 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from fastapi import Depends, HTTPException
+from .database import db, peek_cached
+from .auth import verify_token
+
+# Admission control for the service router. Requests take a slot before they
+# reach check_access; when every slot is busy they wait in a queue ordered by
+# plan priority (higher first), and the queue sheds the lowest priority work
+# when it is full or a request has waited too long. The global concurrency
+# limit follows AIMD on the latency of admitted requests, which is dominated
+# by the Mongo round trips in check_access. A request is queued before it
+# touches the database: its plan comes from the documents check_access and
+# get_current_user cached, and a user seen for the first time is admitted
+# without plan priority or cap.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "100"))
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "4"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "200"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "2"))
+ADMISSION_TARGET_LATENCY_MS = float(os.getenv("ADMISSION_TARGET_LATENCY_MS", "250"))
+ADMISSION_ADJUST_SECONDS = float(os.getenv("ADMISSION_ADJUST_SECONDS", "0.5"))
+
+# Multiplicative decrease factor and weight of the newest latency sample
+DECREASE_FACTOR = 0.7
+LATENCY_SMOOTHING = 0.2
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        min_concurrency: int = ADMISSION_MIN_CONCURRENCY,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        target_latency: float = ADMISSION_TARGET_LATENCY_MS / 1000,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.latency = 0.0
+        self._plan_in_flight: Dict[Optional[str], int] = defaultdict(int)
+        self._plan_limits: Dict[Optional[str], Optional[int]] = {}
+        # Entries are [-priority, seq, plan_name, future]
+        self._queue: List[list] = []
+        self._seq = itertools.count()
+        self._last_adjust = time.monotonic()
+        self.admitted: Dict[Optional[str], int] = defaultdict(int)
+        self.shed: Dict[Tuple[Optional[str], str], int] = defaultdict(int)
+
+    def _has_capacity(self, plan_name: Optional[str]) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        plan_limit = self._plan_limits.get(plan_name)
+        return plan_limit is None or self._plan_in_flight[plan_name] < plan_limit
+
+    def _start(self, plan_name: Optional[str]):
+        self.in_flight += 1
+        self._plan_in_flight[plan_name] += 1
+        self.admitted[plan_name] += 1
+
+    def retry_after(self) -> int:
+        # Time for the current queue to drain at the current limit
+        waiting = len(self._queue) + 1
+        return max(1, math.ceil(waiting * max(self.latency, self.target_latency) / max(1, int(self.limit))))
+
+    def _reject(self, plan_name: Optional[str], reason: str) -> HTTPException:
+        self.shed[(plan_name, reason)] += 1
+        return HTTPException(
+            status_code=503,
+            detail="Service overloaded, retry later",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def acquire(self, plan_name: Optional[str], priority: int = 0, plan_limit: Optional[int] = None):
+        self._plan_limits[plan_name] = plan_limit
+        if not self._queue and self._has_capacity(plan_name):
+            self._start(plan_name)
+            return
+
+        if len(self._queue) >= self.queue_size:
+            lowest = max(self._queue)
+            if lowest[0] <= -priority:
+                raise self._reject(plan_name, "queue_full")
+            # Make room by shedding the lowest priority waiter
+            self._queue.remove(lowest)
+            heapq.heapify(self._queue)
+            lowest[3].set_exception(self._reject(lowest[2], "preempted"))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [-priority, next(self._seq), plan_name, future]
+        heapq.heappush(self._queue, entry)
+        # Waiters held back by their own plan's cap must not block other plans
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(entry):
+                raise self._reject(plan_name, "timeout")
+            # Admitted just as the timer fired; keep the slot
+        except asyncio.CancelledError:
+            # The client went away; hand back a slot that was already granted
+            if not self._abandon(entry):
+                self._finish(plan_name)
+                self._dispatch()
+            raise
+
+    def _abandon(self, entry: list) -> bool:
+        future = entry[3]
+        if future.done() and not future.cancelled() and future.exception() is None:
+            return False
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        future.cancel()
+        return True
+
+    def _finish(self, plan_name: Optional[str]):
+        self.in_flight -= 1
+        self._plan_in_flight[plan_name] -= 1
+
+    def release(self, plan_name: Optional[str], latency: float):
+        self._finish(plan_name)
+        self._observe(latency)
+        self._dispatch()
+
+    def _observe(self, latency: float):
+        self.latency = latency if self.latency == 0 else self.latency + LATENCY_SMOOTHING * (latency - self.latency)
+        now = time.monotonic()
+        if now - self._last_adjust < ADMISSION_ADJUST_SECONDS:
+            return
+        self._last_adjust = now
+        if self.latency > self.target_latency:
+            self.limit = max(self.min_concurrency, self.limit * DECREASE_FACTOR)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1)
+
+    def _dispatch(self):
+        # Start the highest priority waiters whose plan still has room
+        skipped = []
+        while self._queue and self.in_flight < int(self.limit):
+            entry = heapq.heappop(self._queue)
+            if entry[3].done():
+                continue
+            if self._has_capacity(entry[2]):
+                self._start(entry[2])
+                entry[3].set_result(None)
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def stats(self) -> dict:
+        shed: Dict[str, Dict[str, int]] = defaultdict(dict)
+        for (plan_name, reason), count in self.shed.items():
+            shed[plan_name or "none"][reason] = count
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "concurrency_limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._queue),
+            "latency_ms": round(self.latency * 1000, 2),
+            "in_flight_by_plan": {k or "none": v for k, v in self._plan_in_flight.items() if v},
+            "admitted_by_plan": {k or "none": v for k, v in self.admitted.items()},
+            "shed_by_plan": dict(shed),
+            "shed_total": sum(self.shed.values())
+        }
+
+
+admission_controller = AdmissionController()
+
+def _plan_settings(user_id: Optional[str]) -> Tuple[Optional[str], int, Optional[int]]:
+    # (plan_name, priority, max_concurrency) from cached documents only
+    user = peek_cached(db.users, {"user_id": user_id}) or {}
+    plan_name = user.get("plan_name")
+    if not plan_name:
+        return None, 0, None
+    plan = peek_cached(db.plans, {"name": plan_name, "is_active": True}) or {}
+    return plan_name, plan.get("priority", 0), plan.get("max_concurrency")
+
+async def admit(payload: dict = Depends(verify_token)):
+    if not ADMISSION_ENABLED:
+        yield
+        return
+
+    plan_name, priority, plan_limit = _plan_settings(payload.get("sub"))
+    await admission_controller.acquire(plan_name, priority, plan_limit)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        admission_controller.release(plan_name, time.monotonic() - started)
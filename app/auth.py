@@ -4,8 +4,9 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from .database import db, serialize_doc
-from uuid import UUID
+from .database import db, serialize_doc, find_one_cached
+from .revocation import revocation_list, to_timestamp
+from uuid import UUID, uuid4
 
 # Security 
 SECRET_KEY = "your-secret-key-keep-it-secret"  
@@ -27,7 +28,9 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # iat keeps its fraction so a token issued right after a revocation in
+    # the same second is not mistaken for an older one
+    to_encode.update({"exp": expire, "iat": to_timestamp(datetime.utcnow()), "jti": uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -42,6 +45,9 @@ async def verify_token(token: str = Depends(oauth2_scheme)):
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
+        # Tokens issued before jti/iat were added count as issued at the epoch
+        if revocation_list.is_revoked(payload.get("jti"), user_id, payload.get("iat", 0)):
+            raise credentials_exception
         return payload
     except JWTError:
         raise credentials_exception
@@ -56,7 +62,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    user = await db.users.find_one({"user_id": user_id})
+    user = await find_one_cached(db.users, {"user_id": user_id})
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
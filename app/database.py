@@ -1,21 +1,44 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from fastapi import FastAPI, HTTPException
 import os
+import asyncio
+import math
 from dotenv import load_dotenv
 from .models import User, Plan, Permission, UsageStats
 from datetime import datetime, timedelta
 from uuid import UUID
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure, ServerSelectionTimeoutError
+from .quota_lease import QuotaLeaseManager, QUOTA_LEASE_MAX_SHARE
+from .resilience import CircuitBreaker, DatabaseUnavailable, LastKnownGood, UsageJournal
+from .shm_counters import SharedCounters, SHM_COUNTERS_ENABLED
+from typing import Dict, List, Optional
+from collections import Counter
 import json
 
 load_dotenv()
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "api_management")
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000"))
 
-client = AsyncIOMotorClient(MONGODB_URL)
+client = AsyncIOMotorClient(MONGODB_URL, serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS)
 db = client[DATABASE_NAME]
 
+# Access checks go through a circuit breaker. While the database is down the
+# user/plan/permission documents and usage counts last read successfully are
+# used instead, and usage increments are journaled locally.
+breaker = CircuitBreaker()
+entitlements = LastKnownGood()
+usage_counts = LastKnownGood()
+
+# Host-local counters shared by all workers; authoritative for quota checks
+# when enabled and written back to the usage collection in the background
+shared_counters = SharedCounters() if SHM_COUNTERS_ENABLED else None
+SHM_SYNC_SECONDS = float(os.getenv("SHM_SYNC_SECONDS", "1"))
+_shm_syncer = None
+
 def serialize_doc(doc):
     if doc is None:
         return None
@@ -33,25 +56,439 @@ def serialize_doc(doc):
     return doc
 
 async def connect_to_mongo():
-    pass
+    try:
+        await ensure_usage_index()
+    except ConnectionFailure:
+        # Start anyway; the first reservation creates the index once the database is back
+        pass
+    await usage_journal.replay_orphans()
+    usage_journal.start(breaker)
+    lease_manager.start()
+    if shared_counters:
+        global _shm_syncer
+        _shm_syncer = asyncio.create_task(_sync_shared_counters_forever())
 
 async def close_mongo_connection():
+    if _shm_syncer:
+        _shm_syncer.cancel()
+        # fcntl locks belong to the process, so the final sync must not start
+        # until the cancelled one has released the sync lock
+        try:
+            await _shm_syncer
+        except asyncio.CancelledError:
+            pass
+        await sync_shared_counters()
+    await lease_manager.stop()
+    await usage_journal.stop()
     if client:
         client.close()
 
 def get_database():
     return db
 
+# Usage storage. The default layout keeps one document per (user_id, endpoint)
+# in db.usage. The compact layout keeps one document per user and subscription
+# period in db.usage_compact, with an endpoint -> counter map and a running
+# total, so reads and resets are single-document operations.
+USAGE_LAYOUT = os.getenv("USAGE_LAYOUT", "per_endpoint")
+COMPACT_USAGE = USAGE_LAYOUT == "compact"
+
+def usage_key(endpoint: str) -> str:
+    # Field names may not contain "." or start with "$"
+    return endpoint.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+def _compact_count(key: str):
+    return {"$ifNull": [f"$endpoints.{key}.count", 0]}
+
+def _compact_increment(user_id: str, grants: dict, period: ObjectId) -> dict:
+    # Pipeline $set adding grants[endpoint] (an expression) to each counter.
+    # Timestamps come from this process like everywhere else, not $$NOW.
+    now = datetime.now()
+    fields = {
+        "user_id": user_id,
+        "period": {"$ifNull": ["$period", period]},
+        "period_start": {"$ifNull": ["$period_start", now]},
+        "last_updated": now,
+        "total": {"$add": [{"$ifNull": ["$total", 0]}, *grants.values()]}
+    }
+    for endpoint, grant in grants.items():
+        key = usage_key(endpoint)
+        fields[f"endpoints.{key}.count"] = {"$add": [_compact_count(key), grant]}
+        fields[f"endpoints.{key}.endpoint"] = {"$literal": endpoint}
+        fields[f"endpoints.{key}.last_updated"] = now
+    return fields
+
+def _compact_record_count(record: Optional[dict], endpoint: str) -> int:
+    return (((record or {}).get("endpoints") or {}).get(usage_key(endpoint)) or {}).get("count", 0)
+
+# Lease and batch reservations rely on one usage document per (user_id, endpoint)
+_usage_index_ready = False
+
+async def _merge_duplicate_usage():
+    # Concurrent upserts without the unique index may have split a counter
+    duplicates = db.usage.aggregate([
+        {"$group": {
+            "_id": {"user_id": "$user_id", "endpoint": "$endpoint"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": "$count"},
+            "last_updated": {"$max": "$last_updated"}
+        }},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ])
+    async for group in duplicates:
+        keep, *extra = group["ids"]
+        await db.usage.update_one(
+            {"_id": keep},
+            {"$set": {"count": group["count"], "last_updated": group["last_updated"]}}
+        )
+        await db.usage.delete_many({"_id": {"$in": extra}})
+
+async def ensure_usage_index():
+    global _usage_index_ready
+    if _usage_index_ready or COMPACT_USAGE:
+        return
+    try:
+        await db.usage.create_index([("user_id", 1), ("endpoint", 1)], unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        await _merge_duplicate_usage()
+        await db.usage.create_index([("user_id", 1), ("endpoint", 1)], unique=True)
+    _usage_index_ready = True
+
+async def get_usage_count(user_id: str, endpoint: str) -> int:
+    if COMPACT_USAGE:
+        record = await db.usage_compact.find_one({"_id": user_id}, {f"endpoints.{usage_key(endpoint)}.count": 1})
+        return _compact_record_count(record, endpoint)
+    record = await db.usage.find_one({"user_id": user_id, "endpoint": endpoint})
+    return record["count"] if record else 0
+
+async def get_usage_stats(user_id: str):
+    # Returns (total, [{"endpoint", "count", "last_updated"}, ...])
+    if COMPACT_USAGE:
+        record = await db.usage_compact.find_one({"_id": user_id}) or {}
+        return record.get("total", 0), list(record.get("endpoints", {}).values())
+    stats = await db.usage.find({"user_id": user_id}).to_list(length=None)
+    return sum(stat.get("count", 0) for stat in stats), stats
+
+async def increment_usage(user_id: str, endpoint: str, count: int = 1):
+    now = datetime.now()
+    if COMPACT_USAGE:
+        key = usage_key(endpoint)
+        await db.usage_compact.update_one(
+            {"_id": user_id},
+            {
+                "$inc": {f"endpoints.{key}.count": count, "total": count},
+                "$set": {
+                    f"endpoints.{key}.endpoint": endpoint,
+                    f"endpoints.{key}.last_updated": now,
+                    "last_updated": now
+                },
+                "$setOnInsert": {"user_id": user_id, "period": ObjectId(), "period_start": now}
+            },
+            upsert=True
+        )
+        return
+    await db.usage.update_one(
+        {"user_id": user_id, "endpoint": endpoint},
+        {"$inc": {"count": count}, "$set": {"last_updated": now}},
+        upsert=True
+    )
+
+async def reset_usage(user_id: str):
+    # The compact document starts an empty period rather than being deleted,
+    # so migrate_usage can tell old per-endpoint records from new usage
+    now = datetime.now()
+    empty = {"user_id": user_id, "period": ObjectId(), "period_start": now, "reset_at": now, "endpoints": {}, "total": 0}
+    if COMPACT_USAGE:
+        await db.usage_compact.replace_one({"_id": user_id}, empty, upsert=True)
+    else:
+        await db.usage.delete_many({"user_id": user_id})
+        # A copy made by an earlier migration run must not keep the old counts
+        await db.usage_compact.replace_one({"_id": user_id}, empty)
+    if shared_counters:
+        shared_counters.reset_user(user_id)
+
+def _lease_grant(current, wanted: int, limit: int) -> dict:
+    # min(wanted, remaining, share of remaining), so blocks shrink as the
+    # counter nears its limit; at least one call while any are left
+    remaining = {"$subtract": [limit, current]}
+    share = {"$max": [1, {"$ceil": {"$multiply": [remaining, QUOTA_LEASE_MAX_SHARE]}}]}
+    return {"$max": [0, {"$min": [wanted, remaining, share]}]}
+
+def _lease_granted(count: int, wanted: int, limit: int) -> int:
+    # What _lease_grant evaluated to against a counter that held `count`
+    remaining = limit - count
+    return max(0, min(wanted, remaining, max(1, math.ceil(remaining * QUOTA_LEASE_MAX_SHARE))))
+
+# Reserve up to `wanted` calls without passing `limit`, in one atomic pipeline
+# update. Returns (granted, ref, count); `ref` identifies the counter the calls
+# were taken from so they are never returned into a reset counter. The
+# pipelines drop their scratch fields, so the grant is worked out from the
+# document as it was before the update.
+async def reserve_usage(user_id: str, endpoint: str, wanted: int, limit: int):
+    if COMPACT_USAGE:
+        current = _compact_count(usage_key(endpoint))
+        period = ObjectId()
+        record = await db.usage_compact.find_one_and_update(
+            {"_id": user_id},
+            [
+                {"$set": {"lease_grant": _lease_grant(current, wanted, limit)}},
+                {"$set": _compact_increment(user_id, {endpoint: "$lease_grant"}, period)},
+                {"$unset": "lease_grant"}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        count = _compact_record_count(record, endpoint)
+        granted = _lease_granted(count, wanted, limit)
+        return granted, (record or {}).get("period") or period, count + granted
+
+    await ensure_usage_index()
+    current = {"$ifNull": ["$count", 0]}
+    for _ in range(2):
+        try:
+            record = await db.usage.find_one_and_update(
+                {"user_id": user_id, "endpoint": endpoint, "count": {"$not": {"$gte": limit}}},
+                [
+                    {"$set": {"lease_grant": _lease_grant(current, wanted, limit)}},
+                    {"$set": {"count": {"$add": [current, "$lease_grant"]}, "last_updated": datetime.now()}},
+                    {"$unset": "lease_grant"}
+                ],
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            # Either the counter is exhausted or it was created concurrently;
+            # only the latter is worth another write
+            record = await db.usage.find_one({"user_id": user_id, "endpoint": endpoint})
+            if record and record["count"] >= limit:
+                return 0, record["_id"], record["count"]
+            continue
+        if record is None:
+            # The upsert created the counter, so it started from zero
+            granted = _lease_granted(0, wanted, limit)
+            created = await db.usage.find_one({"user_id": user_id, "endpoint": endpoint}, {"_id": 1})
+            return granted, created["_id"] if created else None, granted
+        granted = _lease_granted(record.get("count", 0), wanted, limit)
+        return granted, record["_id"], record.get("count", 0) + granted
+    return 0, None, limit
+
+async def release_usage(user_id: str, endpoint: str, count: int, ref):
+    if COMPACT_USAGE:
+        await db.usage_compact.update_one(
+            {"_id": user_id, "period": ref, f"endpoints.{usage_key(endpoint)}.count": {"$gte": count}},
+            {"$inc": {f"endpoints.{usage_key(endpoint)}.count": -count, "total": -count}}
+        )
+        return
+    await db.usage.update_one(
+        {"_id": ref, "count": {"$gte": count}},
+        {"$inc": {"count": -count}}
+    )
+
+# Background refunds; referenced here so they are not garbage collected
+_background_tasks = set()
+
+def _in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _refund_or_journal(user_id: str, calls: Dict[str, int], ref=None):
+    try:
+        await refund_usage_batch(user_id, calls, ref)
+    except ServerSelectionTimeoutError:
+        # Never sent; anything else may have been applied
+        for endpoint, count in calls.items():
+            usage_journal.record(user_id, endpoint, -count)
+
+async def _write_or_refund(user_id: str, write, charged):
+    # The breaker gives up on a slow call by cancelling it, but the write may
+    # still commit. Let it finish and give back whatever it charged;
+    # charged(result) -> (calls, ref).
+    task = asyncio.ensure_future(write)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        def refund(done):
+            if done.cancelled() or done.exception() is not None:
+                return
+            calls, ref = charged(done.result())
+            if calls:
+                _in_background(_refund_or_journal(user_id, calls, ref))
+        task.add_done_callback(refund)
+        raise
+
+# Add calls[endpoint] to every counter unless that would pass `limit`.
+# Returns (refused endpoints, calls to refund). With atomic=True nothing may
+# stay charged when any endpoint is refused; the caller gives the refunds
+# back with refund_usage_batch(). If the caller is cancelled or the write
+# fails, everything the write charged is given back in the background.
+async def reserve_usage_batch(user_id: str, calls: Dict[str, int], limit: int, atomic: bool):
+    if COMPACT_USAGE:
+        # Every counter lives in one document, so this is a single atomic update
+        fits = {
+            usage_key(endpoint): {"$lte": [{"$add": [_compact_count(usage_key(endpoint)), count]}, limit]}
+            for endpoint, count in calls.items()
+        }
+        all_fit = {"$allElementsTrue": [[f"$batch_ok.{key}" for key in fits]]}
+        grants = {
+            endpoint: {"$cond": [all_fit if atomic else f"$batch_ok.{usage_key(endpoint)}", count, 0]}
+            for endpoint, count in calls.items()
+        }
+        period = ObjectId()
+
+        def refused(record):
+            # Same test as batch_ok, against the counters before the update
+            return {endpoint for endpoint, count in calls.items() if _compact_record_count(record, endpoint) + count > limit}
+
+        def charged(record):
+            failed = refused(record)
+            if atomic and failed:
+                return {}, None
+            return {endpoint: count for endpoint, count in calls.items() if endpoint not in failed}, (record or {}).get("period") or period
+
+        record = await _write_or_refund(user_id, db.usage_compact.find_one_and_update(
+            {"_id": user_id},
+            [
+                {"$set": {"batch_ok": fits}},
+                {"$set": _compact_increment(user_id, grants, period)},
+                {"$unset": "batch_ok"}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        ), charged)
+        return refused(record), {}
+
+    # An exhausted counter fails the filter, so the upsert collides with the
+    # unique (user_id, endpoint) index and shows up as a write error.
+    await ensure_usage_index()
+    pending = list(calls)
+    now = datetime.now()
+    requests = [
+        UpdateOne(
+            {"user_id": user_id, "endpoint": endpoint, "count": {"$not": {"$gt": limit - calls[endpoint]}}},
+            {"$inc": {"count": calls[endpoint]}, "$set": {"last_updated": now}},
+            upsert=True
+        )
+        for endpoint in pending
+    ]
+
+    async def write():
+        # Returns (endpoints not written, unexpected error); with ordered=False
+        # every other request was applied
+        try:
+            await db.usage.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            unexpected = any(write_error.get("code") != 11000 for write_error in write_errors)
+            return {pending[write_error["index"]] for write_error in write_errors}, e if unexpected else None
+        return set(), None
+
+    def charged(result):
+        return {endpoint: calls[endpoint] for endpoint in pending if endpoint not in result[0]}, None
+
+    failed, error = await _write_or_refund(user_id, write(), charged)
+    if error is not None:
+        # The request fails, so nothing it charged may stay
+        refunds = charged((failed, error))[0]
+        if refunds:
+            _in_background(_refund_or_journal(user_id, refunds))
+        raise error
+
+    if atomic and failed:
+        # Give back what was reserved for the endpoints that did succeed
+        return failed, {endpoint: calls[endpoint] for endpoint in pending if endpoint not in failed}
+    return failed, {}
+
+async def refund_usage_batch(user_id: str, calls: Dict[str, int], ref=None):
+    if COMPACT_USAGE:
+        # `ref` is the period the calls were charged to
+        keys = {usage_key(endpoint): count for endpoint, count in calls.items()}
+        await db.usage_compact.update_one(
+            {"_id": user_id, "period": ref, **{f"endpoints.{key}.count": {"$gte": count} for key, count in keys.items()}},
+            {"$inc": {"total": -sum(keys.values()), **{f"endpoints.{key}.count": -count for key, count in keys.items()}}}
+        )
+        return
+    await db.usage.bulk_write(
+        [
+            UpdateOne(
+                {"user_id": user_id, "endpoint": endpoint, "count": {"$gte": count}},
+                {"$inc": {"count": -count}}
+            )
+            for endpoint, count in calls.items()
+        ],
+        ordered=False
+    )
+
+async def get_usage_report(user_id: str):
+    # Returns (total, per-endpoint usage with permission names)
+    total, stats = await get_usage_stats(user_id)
+    endpoints = [stat.get("endpoint", "unknown") for stat in stats]
+    permissions = await db.permissions.find({"endpoint": {"$in": endpoints}}).to_list(length=None)
+    permission_names = {p["endpoint"]: p["name"] for p in permissions}
+    return total, [
+        {
+            "endpoint": stat.get("endpoint", "unknown"),
+            "permission_name": permission_names.get(stat.get("endpoint"), "unknown"),
+            "count": stat.get("count", 0),
+            "last_access": stat.get("last_updated")
+        }
+        for stat in stats
+    ]
+
+def database_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Database unavailable",
+        headers={"Retry-After": str(breaker.retry_after())}
+    )
+
+def _cache_key(collection, query: dict):
+    return (collection.name, tuple(sorted(query.items())))
+
+def peek_cached(collection, query: dict):
+    # The document find_one_cached last read for this query, without any I/O
+    found, doc = entitlements.get(_cache_key(collection, query))
+    return dict(doc) if found and doc else None
+
+async def find_one_cached(collection, query: dict):
+    key = _cache_key(collection, query)
+    try:
+        doc = await breaker.call(lambda: collection.find_one(query))
+    except DatabaseUnavailable:
+        found, doc = entitlements.get(key)
+        if not found:
+            raise database_unavailable()
+        return dict(doc) if doc else doc
+    # Callers may serialize the document in place, so cache a copy
+    entitlements.put(key, dict(doc) if doc else doc)
+    return doc
+
+async def _apply_journaled_usage(user_id: str, endpoint: str, count: int):
+    await breaker.call(lambda: increment_usage(user_id, endpoint, count))
+
+usage_journal = UsageJournal(_apply_journaled_usage)
+
+def _consume_journaled(user_id: str, endpoint: str, limit: int) -> bool:
+    found, usage = usage_counts.get((user_id, endpoint))
+    if not found:
+        raise database_unavailable()
+    if usage + usage_journal.pending_count(user_id, endpoint) >= limit:
+        return False
+    usage_journal.record(user_id, endpoint)
+    return True
+
 # Access control function
 async def check_access(user_id: str, endpoint: str):
-    user = await db.users.find_one({"user_id": user_id})
+    user = await find_one_cached(db.users, {"user_id": user_id})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid user ID")
     
     if not user.get("plan_name"):
         raise HTTPException(status_code=403, detail="User has no plan")
 
-    plan_data = await db.plans.find_one({"name": user["plan_name"], "is_active": True})
+    plan_data = await find_one_cached(db.plans, {"name": user["plan_name"], "is_active": True})
     if not plan_data:
         raise HTTPException(status_code=404, detail="Plan not found or inactive")
     plan = Plan(**plan_data)
@@ -59,23 +496,211 @@ async def check_access(user_id: str, endpoint: str):
     if user.get("subscription_end") and user["subscription_end"] < datetime.now():
         raise HTTPException(status_code=403, detail="Subscription expired")
 
-    permission = await db.permissions.find_one({"endpoint": endpoint})
+    permission = await find_one_cached(db.permissions, {"endpoint": endpoint})
     if not permission:
         raise HTTPException(status_code=404, detail="Permission not found")
 
     if permission["name"] not in plan.permissions:
         raise HTTPException(status_code=403, detail="Permission denied")
 
-    usage_record = await db.usage.find_one({"user_id": user_id, "endpoint": endpoint})
-    usage = usage_record["count"] if usage_record else 0
+    if shared_counters:
+        allowed = shared_counters.consume(user_id, endpoint, plan.call_limit)
+        if allowed is None:
+            # First call for this key on this host: seed it from the database
+            try:
+                usage = await breaker.call(lambda: get_usage_count(user_id, endpoint))
+            except DatabaseUnavailable:
+                raise database_unavailable()
+            if shared_counters.seed(user_id, endpoint, usage):
+                allowed = shared_counters.consume(user_id, endpoint, plan.call_limit)
+        if allowed is False:
+            raise HTTPException(status_code=429, detail="API call limit exceeded")
+        if allowed:
+            return
+        # No room in the table for this key; use the database path below
+
+    if lease_manager.enabled:
+        try:
+            allowed = await lease_manager.consume(user_id, endpoint, plan.call_limit)
+        except DatabaseUnavailable:
+            allowed = _consume_journaled(user_id, endpoint, plan.call_limit)
+        if not allowed:
+            raise HTTPException(status_code=429, detail="API call limit exceeded")
+        return
+
+    try:
+        usage = await breaker.call(lambda: get_usage_count(user_id, endpoint))
+    except DatabaseUnavailable:
+        if not _consume_journaled(user_id, endpoint, plan.call_limit):
+            raise HTTPException(status_code=429, detail="API call limit exceeded")
+        return
+    usage_counts.put((user_id, endpoint), usage)
     if usage >= plan.call_limit:
         raise HTTPException(status_code=429, detail="API call limit exceeded")
 
-    await db.usage.update_one(
-        {"user_id": user_id, "endpoint": endpoint},
-        {"$inc": {"count": 1}, "$set": {"last_updated": datetime.now()}},
-        upsert=True
-    )
+    try:
+        await breaker.call(lambda: increment_usage(user_id, endpoint))
+    except DatabaseUnavailable as e:
+        # Journal only writes that certainly failed; one cut short by the
+        # timeout may have landed and replaying it would count the call twice
+        if e.not_sent:
+            usage_journal.record(user_id, endpoint)
+        return
+    usage_counts.put((user_id, endpoint), usage + 1)
+
+# Quota leasing goes through the breaker and keeps the last known count
+# fresh for the journaled fallback.
+async def _reserve_usage(user_id: str, endpoint: str, wanted: int, limit: int):
+    granted, ref, count = await breaker.call(lambda: reserve_usage(user_id, endpoint, wanted, limit))
+    usage_counts.put((user_id, endpoint), count)
+    return granted, ref
+
+async def _release_usage(user_id: str, endpoint: str, count: int, ref):
+    await breaker.call(lambda: release_usage(user_id, endpoint, count, ref))
+
+lease_manager = QuotaLeaseManager(_reserve_usage, _release_usage)
+
+async def sync_shared_counters():
+    # Only one worker per host writes the deltas back at a time
+    if not shared_counters or not shared_counters.try_lock_sync():
+        return
+    try:
+        deltas = shared_counters.collect()
+        handled = set()
+        try:
+            for (user_id, endpoint), delta in deltas.items():
+                # A write cut short, by a timeout or by cancellation, may have
+                # landed; restoring it would count it twice
+                handled.add((user_id, endpoint))
+                try:
+                    await breaker.call(lambda: increment_usage(user_id, endpoint, delta))
+                except DatabaseUnavailable as e:
+                    if e.not_sent:
+                        shared_counters.restore(user_id, endpoint, delta)
+                except Exception:
+                    shared_counters.restore(user_id, endpoint, delta)
+        finally:
+            # Cancelled part way: the deltas never attempted go back for the next sync
+            for (user_id, endpoint), delta in deltas.items():
+                if (user_id, endpoint) not in handled:
+                    shared_counters.restore(user_id, endpoint, delta)
+    finally:
+        shared_counters.unlock_sync()
+
+async def _sync_shared_counters_forever():
+    while True:
+        await asyncio.sleep(SHM_SYNC_SECONDS)
+        try:
+            await sync_shared_counters()
+        except Exception:
+            # Deltas stay in shared memory until the next round
+            pass
+
+# Batch access control: one plan read, one permission read and a single quota
+# write for every endpoint in the batch. `user` is the document already
+# loaded by get_current_user. Returns an HTTPException per endpoint that was
+# refused (None when allowed); with atomic=True either every endpoint gets its
+# quota or none of them do.
+def _refund_shared(user_id: str, calls: Dict[str, int]):
+    for endpoint, count in calls.items():
+        shared_counters.refund(user_id, endpoint, count)
+
+async def _consume_shared_batch(user_id: str, calls: Dict[str, int], limit: int, atomic: bool):
+    # Spend the batch from the host-local counters. Returns (held, refused,
+    # unplaced): calls taken, endpoints over the limit, and calls for keys
+    # with no room in the table, which go to the database instead.
+    results = {endpoint: shared_counters.consume(user_id, endpoint, limit, count) for endpoint, count in calls.items()}
+    missing = [endpoint for endpoint, allowed in results.items() if allowed is None]
+    if missing:
+        # Seed every key this host has not seen yet with one read, like check_access
+        try:
+            _, stats = await breaker.call(lambda: get_usage_stats(user_id))
+        except DatabaseUnavailable:
+            _refund_shared(user_id, {endpoint: calls[endpoint] for endpoint, allowed in results.items() if allowed})
+            raise database_unavailable()
+        usage = {stat.get("endpoint"): stat.get("count", 0) for stat in stats}
+        for endpoint in missing:
+            if shared_counters.seed(user_id, endpoint, usage.get(endpoint, 0)):
+                results[endpoint] = shared_counters.consume(user_id, endpoint, limit, calls[endpoint])
+
+    held = {endpoint: calls[endpoint] for endpoint, allowed in results.items() if allowed}
+    refused = {endpoint for endpoint, allowed in results.items() if allowed is False}
+    if atomic and refused:
+        _refund_shared(user_id, held)
+        held = {}
+    return held, refused, {endpoint: calls[endpoint] for endpoint, allowed in results.items() if allowed is None}
+
+async def check_access_batch(user: dict, endpoints: List[str], atomic: bool = True) -> Dict[str, Optional[HTTPException]]:
+    if not user.get("plan_name"):
+        raise HTTPException(status_code=403, detail="User has no plan")
+
+    plan_data = await find_one_cached(db.plans, {"name": user["plan_name"], "is_active": True})
+    if not plan_data:
+        raise HTTPException(status_code=404, detail="Plan not found or inactive")
+    plan = Plan(**plan_data)
+
+    subscription_end = user.get("subscription_end")
+    if isinstance(subscription_end, str):
+        subscription_end = datetime.fromisoformat(subscription_end)
+    if subscription_end and subscription_end < datetime.now():
+        raise HTTPException(status_code=403, detail="Subscription expired")
+
+    calls = Counter(endpoints)
+    try:
+        permissions = await breaker.call(
+            lambda: db.permissions.find({"endpoint": {"$in": list(calls)}}).to_list(length=None)
+        )
+    except DatabaseUnavailable:
+        raise database_unavailable()
+    permission_names = {p["endpoint"]: p["name"] for p in permissions}
+
+    errors: Dict[str, Optional[HTTPException]] = {}
+    for endpoint, count in calls.items():
+        if endpoint not in permission_names:
+            errors[endpoint] = HTTPException(status_code=404, detail="Permission not found")
+        elif permission_names[endpoint] not in plan.permissions:
+            errors[endpoint] = HTTPException(status_code=403, detail="Permission denied")
+        elif count > plan.call_limit:
+            errors[endpoint] = HTTPException(status_code=429, detail="API call limit exceeded")
+        else:
+            errors[endpoint] = None
+
+    if atomic and any(errors.values()):
+        return errors
+
+    user_id = user["user_id"]
+    pending = {endpoint: calls[endpoint] for endpoint, error in errors.items() if error is None}
+    held = {}
+    if shared_counters and pending:
+        held, refused, pending = await _consume_shared_batch(user_id, pending, plan.call_limit, atomic)
+        for endpoint in refused:
+            errors[endpoint] = HTTPException(status_code=429, detail="API call limit exceeded")
+        if atomic and refused:
+            return errors
+    if not pending:
+        return errors
+
+    # Calls taken from the shared counters are given back unless the batch
+    # goes through, whatever ends it
+    keep_held = False
+    try:
+        try:
+            failed, refunds = await breaker.call(lambda: reserve_usage_batch(user_id, pending, plan.call_limit, atomic))
+        except DatabaseUnavailable:
+            raise database_unavailable()
+        keep_held = not (atomic and failed)
+    finally:
+        if not keep_held:
+            _refund_shared(user_id, held)
+
+    if refunds:
+        # Not under the breaker's timeout, and shielded from the request being
+        # cancelled: a refund cut short would leave the user charged
+        await asyncio.shield(_refund_or_journal(user_id, refunds))
+
+    for endpoint in failed:
+        errors[endpoint] = HTTPException(status_code=429, detail="API call limit exceeded")
+    return errors
 
 # Admin functions for permission management
 async def create_permission(permission: Permission, admin_username: str):
@@ -169,7 +794,8 @@ async def subscribe_user(user_id: str, plan_name: str, duration_days: int = 30):
         }
     )
     
-    await db.usage.delete_many({"user_id": user_id})
+    await reset_usage(user_id)
+    lease_manager.forget_user(user_id)
     
     return {"message": "Subscription successful", "end_date": end_date}
 
@@ -187,8 +813,7 @@ async def get_user_subscription(user_id: str):
     
     plan_data = serialize_doc(plan_data)
     
-    usage_stats = await db.usage.find({"user_id": user_id}).to_list(length=None)
-    total_usage = sum(stat.get("count", 0) for stat in usage_stats)
+    total_usage, _ = await get_usage_stats(user_id)
     
     return {
         "plan": plan_data,
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from .database import connect_to_mongo, close_mongo_connection
+from .revocation import revocation_list
 from .routes import admin, subscription, auth, service
 from .models import User
 import os
@@ -18,9 +19,11 @@ app.include_router(service.router)
 @app.on_event("startup")
 async def startup_db_client():
     await connect_to_mongo()
+    await revocation_list.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    revocation_list.stop()
     await close_mongo_connection()
 
 
@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from .database import db, usage_key
+
+# Copies per-endpoint usage documents (db.usage) into the compact per-user
+# layout (db.usage_compact) in batches while the API keeps running. Each
+# counter remembers how much it has taken from db.usage, and a re-run only
+# adds what changed since, so calls counted in the compact layout are kept.
+# Records last updated before a user's usage was reset in the compact layout
+# belong to the old period and are not added.
+# Run it once, switch the API to USAGE_LAYOUT=compact, then run it again to
+# pick up the calls counted in between.
+#
+#   python -m app.migrate_usage --batch-size 500 --pause 0.1
+
+def _merge(user_id: str, records: list) -> UpdateOne:
+    fields = {
+        "user_id": user_id,
+        "period": {"$ifNull": ["$period", ObjectId()]},
+        # Same clock as the API's usage writes
+        "period_start": {"$ifNull": ["$period_start", datetime.now()]}
+    }
+    for record in records:
+        key = usage_key(record["endpoint"])
+        fields[f"endpoints.{key}.endpoint"] = {"$literal": record["endpoint"]}
+        count = record.get("count", 0)
+        already = {"$ifNull": [f"$endpoints.{key}.migrated", 0]}
+        before_reset = {"$gt": ["$reset_at", record.get("last_updated")]}
+        added = {"$cond": [before_reset, 0, {"$subtract": [count, already]}]}
+        fields[f"endpoints.{key}.count"] = {"$add": [{"$ifNull": [f"$endpoints.{key}.count", 0]}, added]}
+        fields[f"endpoints.{key}.migrated"] = count
+        fields[f"endpoints.{key}.last_updated"] = {"$max": [f"$endpoints.{key}.last_updated", record.get("last_updated")]}
+    return UpdateOne(
+        {"_id": user_id},
+        [
+            {"$set": fields},
+            {"$set": {"total": {"$sum": {"$map": {"input": {"$objectToArray": "$endpoints"}, "in": "$$this.v.count"}}}}}
+        ],
+        upsert=True
+    )
+
+async def migrate(batch_size: int = 500, pause: float = 0.0):
+    last = None
+    migrated = 0
+    while True:
+        query = {}
+        if last:
+            query = {"$or": [
+                {"user_id": {"$gt": last[0]}},
+                {"user_id": last[0], "endpoint": {"$gt": last[1]}}
+            ]}
+        records = await db.usage.find(query).sort([("user_id", 1), ("endpoint", 1)]).limit(batch_size).to_list(length=None)
+        if not records:
+            break
+
+        by_user = {}
+        for record in records:
+            by_user.setdefault(record["user_id"], []).append(record)
+        await db.usage_compact.bulk_write(
+            [_merge(user_id, user_records) for user_id, user_records in by_user.items()],
+            ordered=False
+        )
+
+        migrated += len(records)
+        last = (records[-1]["user_id"], records[-1]["endpoint"])
+        print(f"Migrated {migrated} usage records (last user {last[0]})")
+        if pause:
+            await asyncio.sleep(pause)
+
+    return migrated
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate usage documents to the compact per-user layout")
+    parser.add_argument("--batch-size", type=int, default=500, help="Usage documents read per batch")
+    parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    args = parser.parse_args()
+    migrated = asyncio.run(migrate(args.batch_size, args.pause))
+    print(f"Done, {migrated} usage records migrated")
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,8 @@ class Plan(BaseModel):
     created_at: datetime = datetime.now()
     created_by: str  
     is_active: bool = True
+    priority: int = 0
+    max_concurrency: Optional[int] = None
 
 class SubscriptionDetails(BaseModel):
     plan: Plan
@@ -48,8 +50,24 @@ class PlanCreate(BaseModel):
     description: str
     permissions: List[str]
     call_limit: int
+    priority: int = 0
+    max_concurrency: Optional[int] = None
 
 class PermissionCreate(BaseModel):
     name: str
     endpoint: str
-    description: str 
\ No newline at end of file
+    description: str 
+
+class BatchOperation(BaseModel):
+    service: str
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+    atomic: bool = True
+
+
+class TokenRevocation(BaseModel):
+    token: str
+
+class RevokeBefore(BaseModel):
+    before: datetime
@@ -0,0 +1,197 @@
+import asyncio
+import math
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Quota leasing: each node reserves a block of calls from the central usage
+# counter in one atomic write and spends it locally. The central counter is
+# charged up front and a reservation never pushes it past the plan limit, so
+# the worst-case overshoot against call_limit is zero. Unused calls go back
+# on lease expiry or shutdown.
+QUOTA_LEASE_ENABLED = os.getenv("QUOTA_LEASE_ENABLED", "false").lower() == "true"
+QUOTA_LEASE_TTL_SECONDS = float(os.getenv("QUOTA_LEASE_TTL_SECONDS", "10"))
+QUOTA_LEASE_MIN_BLOCK = int(os.getenv("QUOTA_LEASE_MIN_BLOCK", "1"))
+QUOTA_LEASE_MAX_BLOCK = int(os.getenv("QUOTA_LEASE_MAX_BLOCK", "500"))
+QUOTA_LEASE_SWEEP_SECONDS = float(os.getenv("QUOTA_LEASE_SWEEP_SECONDS", "1"))
+# Largest share of a key's remaining quota one reservation may take, so a
+# single node cannot hoard the last calls while others get 429s
+QUOTA_LEASE_MAX_SHARE = float(os.getenv("QUOTA_LEASE_MAX_SHARE", "0.25"))
+
+# reserve(user_id, endpoint, wanted, limit) -> (granted, lease_ref)
+ReserveFn = Callable[[str, str, int, int], Awaitable[Tuple[int, Any]]]
+# release(user_id, endpoint, count, lease_ref)
+ReleaseFn = Callable[[str, str, int, Any], Awaitable[None]]
+
+# Weight of the newest inter-arrival sample in the per-key rate estimate
+RATE_SMOOTHING = 0.2
+
+
+@dataclass
+class Lease:
+    remaining: int
+    expires_at: float
+    ref: Any = None
+
+
+class QuotaLeaseManager:
+    def __init__(
+        self,
+        reserve: ReserveFn,
+        release: ReleaseFn,
+        enabled: bool = QUOTA_LEASE_ENABLED,
+        ttl: float = QUOTA_LEASE_TTL_SECONDS,
+        min_block: int = QUOTA_LEASE_MIN_BLOCK,
+        max_block: int = QUOTA_LEASE_MAX_BLOCK,
+    ):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_block = max(1, min_block)
+        self.max_block = max(self.min_block, max_block)
+        self._reserve = reserve
+        self._release = release
+        self._leases: Dict[Tuple[str, str], Lease] = {}
+        self._rates: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # Keys whose counter was found exhausted, refused locally until expiry
+        self._exhausted: Dict[Tuple[str, str], float] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.reservations = 0
+        self.local_hits = 0
+        self.local_rejections = 0
+        self.failed_releases = 0
+
+    def _observe(self, key: Tuple[str, str], now: float):
+        rate, last_seen = self._rates.get(key, (0.0, now))
+        elapsed = now - last_seen
+        if elapsed > 0:
+            sample = 1.0 / elapsed
+            rate = sample if rate == 0 else rate + RATE_SMOOTHING * (sample - rate)
+        self._rates[key] = (rate, now)
+
+    def block_size(self, key: Tuple[str, str]) -> int:
+        rate = self._rates.get(key, (0.0, 0.0))[0]
+        return min(self.max_block, max(self.min_block, math.ceil(rate * self.ttl)))
+
+    async def consume(self, user_id: str, endpoint: str, limit: int) -> bool:
+        key = (user_id, endpoint)
+        now = time.monotonic()
+        self._observe(key, now)
+
+        lease = self._leases.get(key)
+        if lease and lease.remaining > 0 and lease.expires_at > now:
+            lease.remaining -= 1
+            self.local_hits += 1
+            return True
+
+        exhausted_until = self._exhausted.get(key)
+        if exhausted_until is not None:
+            if exhausted_until > now:
+                self.local_rejections += 1
+                return False
+            del self._exhausted[key]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Another request may have refilled the lease while we waited
+            now = time.monotonic()
+            lease = self._leases.get(key)
+            if lease and lease.remaining > 0 and lease.expires_at > now:
+                lease.remaining -= 1
+                self.local_hits += 1
+                return True
+
+            if lease:
+                # Dropped only once its calls are back; if the release fails
+                # the sweeper retries it
+                if lease.remaining > 0:
+                    await self._release(user_id, endpoint, lease.remaining, lease.ref)
+                self._leases.pop(key, None)
+
+            granted, ref = await self._reserve(user_id, endpoint, self.block_size(key), limit)
+            self.reservations += 1
+            if granted <= 0:
+                # Calls returned by other nodes become usable after the TTL
+                self._exhausted[key] = now + self.ttl
+                return False
+
+            self._leases[key] = Lease(remaining=granted - 1, expires_at=now + self.ttl, ref=ref)
+            return True
+
+    async def release_expired(self):
+        now = time.monotonic()
+        expired = [key for key, lease in self._leases.items() if lease.expires_at <= now]
+        await self._return_leases(expired)
+        for key in [key for key, until in self._exhausted.items() if until <= now]:
+            del self._exhausted[key]
+
+        # Forget rate history for keys that have gone quiet
+        stale = [key for key, (_, last_seen) in self._rates.items() if now - last_seen > self.ttl * 10]
+        for key in stale:
+            del self._rates[key]
+            if key not in self._leases:
+                self._locks.pop(key, None)
+
+    async def release_all(self):
+        await self._return_leases(list(self._leases))
+
+    async def _return_leases(self, keys):
+        for key in keys:
+            try:
+                await self._return_lease(key)
+            except Exception:
+                # The lease stays until a later sweep manages to return it
+                self.failed_releases += 1
+
+    async def _return_lease(self, key: Tuple[str, str]):
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            lease = self._leases.get(key)
+            if lease and lease.remaining > 0:
+                await self._release(key[0], key[1], lease.remaining, lease.ref)
+            self._leases.pop(key, None)
+
+    def forget_user(self, user_id: str):
+        # The central counter was reset, so outstanding calls belong to a
+        # period that no longer exists and must not be spent or returned.
+        for key in [key for key in self._leases if key[0] == user_id]:
+            del self._leases[key]
+        for key in [key for key in self._exhausted if key[0] == user_id]:
+            del self._exhausted[key]
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(QUOTA_LEASE_SWEEP_SECONDS)
+            try:
+                await self.release_expired()
+            except Exception:
+                # Keep sweeping; the next round retries
+                pass
+
+    def start(self):
+        if self.enabled and self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        # Best effort: calls that cannot be returned stay charged, but
+        # shutdown goes on
+        if self._sweeper:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        await self.release_all()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "active_leases": len(self._leases),
+            "leased_calls": sum(lease.remaining for lease in self._leases.values()),
+            "reservations": self.reservations,
+            "local_hits": self.local_hits,
+            "local_rejections": self.local_rejections,
+            "exhausted_keys": len(self._exhausted),
+            "failed_releases": self.failed_releases,
+        }
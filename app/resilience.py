@@ -0,0 +1,272 @@
+import asyncio
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, ServerSelectionTimeoutError, WTimeoutError
+
+# Circuit breaker around Mongo calls. Only outage-type errors count as
+# failures; query results such as duplicate keys are passed through untouched.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "10"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+DB_CALL_TIMEOUT_SECONDS = float(os.getenv("DB_CALL_TIMEOUT_SECONDS", "2"))
+# How old a last-known-good entitlement may be and still be served
+ENTITLEMENT_STALE_SECONDS = float(os.getenv("ENTITLEMENT_STALE_SECONDS", "300"))
+USAGE_JOURNAL_PATH = os.getenv("USAGE_JOURNAL_PATH", "usage_journal")
+USAGE_JOURNAL_REPLAY_SECONDS = float(os.getenv("USAGE_JOURNAL_REPLAY_SECONDS", "5"))
+
+OUTAGE_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError, asyncio.TimeoutError)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DatabaseUnavailable(Exception):
+    # not_sent: the operation certainly never reached the database. Otherwise
+    # (timeouts, dropped connections) a write may still have been applied.
+    def __init__(self, message: str = "", not_sent: bool = False):
+        super().__init__(message)
+        self.not_sent = not_sent
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_SECONDS,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES,
+        call_timeout: float = DB_CALL_TIMEOUT_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.call_timeout = call_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probes = 0
+        self.rejected = 0
+
+    def _allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self._probes = 0
+        if self._probes >= self.half_open_probes:
+            return False
+        self._probes += 1
+        return True
+
+    def _trip(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def retry_after(self) -> int:
+        if self.state != OPEN:
+            return 1
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1)
+
+    async def call(self, operation: Callable[[], Awaitable[Any]]) -> Any:
+        if not self._allow():
+            self.rejected += 1
+            raise DatabaseUnavailable("Circuit open", not_sent=True)
+
+        try:
+            result = await asyncio.wait_for(operation(), self.call_timeout)
+        except OUTAGE_ERRORS as e:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._trip()
+            raise DatabaseUnavailable(
+                str(e) or type(e).__name__,
+                not_sent=isinstance(e, ServerSelectionTimeoutError)
+            ) from e
+        except asyncio.CancelledError:
+            # The caller went away mid-probe; let the next call probe instead
+            if self.state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+            raise
+        except Exception:
+            # The database answered, it just rejected the operation
+            self.failures = 0
+            self.state = CLOSED
+            raise
+
+        self.failures = 0
+        self.state = CLOSED
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected_calls": self.rejected,
+            "retry_after": self.retry_after() if self.state == OPEN else None
+        }
+
+
+class LastKnownGood:
+    def __init__(self, max_age: float = ENTITLEMENT_STALE_SECONDS, max_entries: int = 100000):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def put(self, key: Hashable, value: Any):
+        if len(self._entries) >= self.max_entries and key not in self._entries:
+            self.prune()
+        self._entries[key] = (time.monotonic(), value)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.max_age:
+            return False, None
+        return True, entry[1]
+
+    def prune(self):
+        now = time.monotonic()
+        self._entries = {key: entry for key, entry in self._entries.items() if now - entry[0] <= self.max_age}
+        # Still full of fresh entries: drop the oldest half
+        if len(self._entries) >= self.max_entries:
+            keep = sorted(self._entries.items(), key=lambda item: item[1][0])[len(self._entries) // 2:]
+            self._entries = dict(keep)
+
+
+class UsageJournal:
+    # Usage increments that could not be written are appended to a per-process
+    # file and replayed once the database is reachable again. A journal left
+    # behind by a process that died is replayed by the next one to start.
+    def __init__(
+        self,
+        apply: Callable[[str, str, int], Awaitable[None]],
+        path: str = USAGE_JOURNAL_PATH,
+    ):
+        self._apply = apply
+        self.base_path = path
+        self.path = f"{path}.{os.getpid()}"
+        self.pending: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._replayer: Optional[asyncio.Task] = None
+
+    def record(self, user_id: str, endpoint: str, count: int = 1):
+        with open(self.path, "a") as journal:
+            journal.write(json.dumps({"user_id": user_id, "endpoint": endpoint, "count": count, "at": time.time()}) + "\n")
+        self.pending[(user_id, endpoint)] += count
+
+    def pending_count(self, user_id: str, endpoint: str) -> int:
+        return self.pending.get((user_id, endpoint), 0)
+
+    async def _replay_file(self, path: str) -> bool:
+        replaying = path if path.endswith(".replaying") else path + ".replaying"
+        if replaying != path:
+            if os.path.exists(replaying):
+                # Never overwrite entries that still have to be applied
+                with open(path) as source, open(replaying, "a") as journal:
+                    journal.write(source.read())
+                os.remove(path)
+            else:
+                os.replace(path, replaying)
+
+        totals: Dict[Tuple[str, str], int] = defaultdict(int)
+        with open(replaying) as journal:
+            for line in journal:
+                if line.strip():
+                    entry = json.loads(line)
+                    totals[(entry["user_id"], entry["endpoint"])] += entry["count"]
+
+        applied = set()
+        try:
+            for (user_id, endpoint), count in totals.items():
+                try:
+                    await self._apply(user_id, endpoint, count)
+                except DatabaseUnavailable as e:
+                    if not e.not_sent:
+                        # It may have been written; replaying it again could count it twice
+                        applied.add((user_id, endpoint))
+                    raise
+                applied.add((user_id, endpoint))
+        except DatabaseUnavailable:
+            return False
+        finally:
+            # Keep only what is left, whatever stopped the replay
+            remaining = {key: count for key, count in totals.items() if key not in applied}
+            if remaining:
+                with open(replaying, "w") as journal:
+                    for (user_id, endpoint), count in remaining.items():
+                        journal.write(json.dumps({"user_id": user_id, "endpoint": endpoint, "count": count}) + "\n")
+            else:
+                os.remove(replaying)
+        return True
+
+    async def replay(self) -> bool:
+        # Partially applied replays and claimed orphans, .replaying files first
+        leftovers = sorted(glob.glob(f"{self.path}.*"), key=lambda path: not path.endswith(".replaying"))
+        if not self.pending and not leftovers:
+            return True
+        pending = dict(self.pending)
+        for path in leftovers + [self.path]:
+            # A plain file may already have been merged into its .replaying file
+            if os.path.exists(path) and not await self._replay_file(path):
+                return False
+        for key, count in pending.items():
+            self.pending[key] -= count
+            if self.pending[key] <= 0:
+                del self.pending[key]
+        return True
+
+    async def replay_orphans(self):
+        for path in glob.glob(f"{self.base_path}.*"):
+            name = path[len(self.base_path) + 1:]
+            pid = name.split(".")[0]
+            if not pid.isdigit() or int(pid) == os.getpid() or _process_alive(int(pid)):
+                continue
+            # Claim the file under our own pid so other workers leave it
+            # alone; whoever renames it first replays it
+            try:
+                os.rename(path, f"{self.path}.orphan-{name}")
+            except FileNotFoundError:
+                continue
+        await self.replay()
+
+    async def _run(self, breaker: CircuitBreaker):
+        while True:
+            await asyncio.sleep(USAGE_JOURNAL_REPLAY_SECONDS)
+            if breaker.state == OPEN:
+                continue
+            try:
+                await self.replay()
+            except Exception:
+                # Leave the journal in place; the next round retries it
+                pass
+
+    def start(self, breaker: CircuitBreaker):
+        if self._replayer is None:
+            self._replayer = asyncio.create_task(self._run(breaker))
+
+    async def stop(self):
+        if self._replayer:
+            self._replayer.cancel()
+            self._replayer = None
+        await self.replay()
+
+    def stats(self) -> dict:
+        return {
+            "pending_calls": sum(self.pending.values()),
+            "pending_keys": len(self.pending),
+            "path": self.path
+        }
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,170 @@
+import asyncio
+import calendar
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from .database import db
+
+# Revocations live in db.revoked_tokens and expire together with the tokens
+# they cover. Each worker keeps an in-memory copy that is refreshed
+# incrementally, so verify_token never queries the database.
+REVOCATION_REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "5"))
+REVOCATION_BLOOM_BITS = int(os.getenv("REVOCATION_BLOOM_BITS", str(1 << 20)))
+REVOCATION_BLOOM_HASHES = int(os.getenv("REVOCATION_BLOOM_HASHES", "4"))
+# How often expired entries are dropped and the Bloom filter rebuilt
+REVOCATION_PRUNE_SECONDS = float(os.getenv("REVOCATION_PRUNE_SECONDS", "300"))
+REVOCATION_REFRESH_OVERLAP = timedelta(seconds=5)
+
+
+def to_timestamp(value: datetime) -> float:
+    # Naive datetimes are UTC, matching the iat/exp claims written by jose
+    if value.tzinfo is not None:
+        return value.timestamp()
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def _round_up_to_millis(value: datetime) -> datetime:
+    # Mongo stores milliseconds; rounding the cutoff up keeps every token
+    # issued before it revoked on the workers that read it back
+    extra = value.microsecond % 1000
+    return value + timedelta(microseconds=1000 - extra) if extra else value
+
+
+class BloomFilter:
+    def __init__(self, bits: int = REVOCATION_BLOOM_BITS, hashes: int = REVOCATION_BLOOM_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def add(self, item: str):
+        h1 = hash(item)
+        h2 = (h1 >> 32) | 1
+        for i in range(self.hashes):
+            index = (h1 + i * h2) % self.bits
+            self._array[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, item: str) -> bool:
+        h1 = hash(item)
+        h2 = (h1 >> 32) | 1
+        for i in range(self.hashes):
+            index = (h1 + i * h2) % self.bits
+            if not self._array[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class RevocationList:
+    def __init__(self):
+        self._bloom = BloomFilter()
+        self._tokens: Dict[str, float] = {}
+        self._users: Dict[str, tuple] = {}
+        self._revoked_before = 0.0
+        self._revoked_before_expires = 0.0
+        self._watermark: Optional[datetime] = None
+        self._next_prune = 0.0
+        self._refresher: Optional[asyncio.Task] = None
+
+    def is_revoked(self, jti: Optional[str], user_id: str, issued_at: float) -> bool:
+        if issued_at < self._revoked_before:
+            return True
+        user_cutoff = self._users.get(user_id)
+        if user_cutoff is not None and issued_at < user_cutoff[0]:
+            return True
+        # The Bloom filter answers the common case; the exact set settles hits
+        return jti is not None and jti in self._bloom and jti in self._tokens
+
+    def _apply(self, doc: dict):
+        kind = doc.get("kind")
+        expires_at = to_timestamp(doc["expires_at"])
+        if kind == "token":
+            self._tokens[doc["jti"]] = expires_at
+            self._bloom.add(doc["jti"])
+        elif kind == "user":
+            cutoff = to_timestamp(doc["revoked_before"])
+            current = self._users.get(doc["user_id"])
+            if current is None or cutoff > current[0]:
+                self._users[doc["user_id"]] = (cutoff, expires_at)
+        elif kind == "all":
+            cutoff = to_timestamp(doc["revoked_before"])
+            if cutoff > self._revoked_before:
+                self._revoked_before = cutoff
+                self._revoked_before_expires = expires_at
+
+    def _prune(self, now: float):
+        self._tokens = {jti: expires for jti, expires in self._tokens.items() if expires > now}
+        self._users = {user_id: entry for user_id, entry in self._users.items() if entry[1] > now}
+        if self._revoked_before_expires <= now:
+            self._revoked_before = 0.0
+        bloom = BloomFilter(self._bloom.bits, self._bloom.hashes)
+        for jti in self._tokens:
+            bloom.add(jti)
+        self._bloom = bloom
+
+    async def refresh(self):
+        query = {}
+        if self._watermark is not None:
+            # Overlap the previous window so late inserts from other workers
+            # are not skipped; applying an entry twice is harmless.
+            query = {"revoked_at": {"$gte": self._watermark - REVOCATION_REFRESH_OVERLAP}}
+        async for doc in db.revoked_tokens.find(query).sort("revoked_at", 1):
+            self._apply(doc)
+            self._watermark = doc["revoked_at"]
+
+        now = to_timestamp(datetime.utcnow())
+        if now >= self._next_prune:
+            self._prune(now)
+            self._next_prune = now + REVOCATION_PRUNE_SECONDS
+
+    async def _record(self, doc: dict):
+        doc["revoked_at"] = datetime.utcnow()
+        await db.revoked_tokens.insert_one(doc)
+        # Apply locally right away; other workers pick it up on their next refresh
+        self._apply(doc)
+
+    async def revoke_token(self, jti: str, user_id: str, expires_at: datetime):
+        await self._record({"kind": "token", "jti": jti, "user_id": user_id, "expires_at": expires_at})
+
+    async def revoke_user(self, user_id: str, token_lifetime: timedelta, before: Optional[datetime] = None):
+        before = _round_up_to_millis(before or datetime.utcnow())
+        await self._record({
+            "kind": "user",
+            "user_id": user_id,
+            "revoked_before": before,
+            "expires_at": before + token_lifetime
+        })
+
+    async def revoke_all(self, before: datetime, token_lifetime: timedelta):
+        before = _round_up_to_millis(before)
+        await self._record({"kind": "all", "revoked_before": before, "expires_at": before + token_lifetime})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+            try:
+                await self.refresh()
+            except Exception:
+                # Keep serving from the last snapshot; the next refresh catches up
+                pass
+
+    async def start(self):
+        await db.revoked_tokens.create_index("expires_at", expireAfterSeconds=0)
+        await db.revoked_tokens.create_index("revoked_at")
+        await self.refresh()
+        if self._refresher is None:
+            self._refresher = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            self._refresher = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked_tokens": len(self._tokens),
+            "revoked_users": len(self._users),
+            "revoked_before": datetime.utcfromtimestamp(self._revoked_before) if self._revoked_before else None,
+            "last_refresh_watermark": self._watermark
+        }
+
+
+revocation_list = RevocationList()
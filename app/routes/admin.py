@@ -1,13 +1,18 @@
 from fastapi import APIRouter, HTTPException, Depends, Path
 from uuid import uuid4
-from ..models import Permission, Plan, PermissionCreate, PlanCreate, User
+from jose import JWTError, jwt
+from ..models import Permission, Plan, PermissionCreate, PlanCreate, User, TokenRevocation, RevokeBefore
 from ..database import (
     create_permission, get_permissions, update_permission, delete_permission,
-    create_plan, get_plans, update_plan, delete_plan, db, serialize_doc
+    create_plan, get_plans, update_plan, delete_plan, db, serialize_doc,
+    lease_manager, breaker, usage_journal, reset_usage, get_usage_report,
+    shared_counters
 )
-from ..auth import get_current_user
+from ..auth import get_current_user, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from ..revocation import revocation_list
+from ..admission import admission_controller
 from typing import List
-from datetime import datetime
+from datetime import datetime, timedelta
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -70,6 +75,8 @@ async def create_new_plan(
         description=plan.description,
         permissions=plan.permissions,
         call_limit=plan.call_limit,
+        priority=plan.priority,
+        max_concurrency=plan.max_concurrency,
         created_at=datetime.now(),
         created_by=admin["username"],
         is_active=True
@@ -95,6 +102,8 @@ async def update_existing_plan(
         description=plan.description,
         permissions=plan.permissions,
         call_limit=plan.call_limit,
+        priority=plan.priority,
+        max_concurrency=plan.max_concurrency,
         created_at=existing.get("created_at", datetime.now()),
         created_by=existing.get("created_by", admin["username"]),
         is_active=existing.get("is_active", True)
@@ -144,7 +153,8 @@ async def delete_user(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
-    await db.usage.delete_many({"user_id": user_id})
+    await reset_usage(user_id)
+    lease_manager.forget_user(user_id)
     return {"message": "User deleted"}
 
 @router.post("/users/{username}/assign-plan/{plan_name}")
@@ -165,7 +175,8 @@ async def assign_plan(
         {"$set": {"plan_name": plan_name}}
     )
     
-    await db.usage.delete_many({"user_id": user["user_id"]})
+    await reset_usage(user["user_id"])
+    lease_manager.forget_user(user["user_id"])
     return {"message": "Plan assigned"}
 
 @router.get("/users/{username}/usage", summary="Get usage statistics for a user")
@@ -177,23 +188,7 @@ async def get_user_usage(
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    usage_stats = await db.usage.find({"user_id": user["user_id"]}).to_list(length=None)
-    
-    detailed_stats = []
-    total_usage = 0
-    
-    for stat in usage_stats:
-        endpoint = stat.get("endpoint", "unknown")
-        permission = await db.permissions.find_one({"endpoint": endpoint})
-        
-        detailed_stat = {
-            "endpoint": endpoint,
-            "permission_name": permission["name"] if permission else "unknown",
-            "count": stat.get("count", 0),
-            "last_access": stat.get("last_updated", None)
-        }
-        detailed_stats.append(detailed_stat)
-        total_usage += stat.get("count", 0)
+    total_usage, detailed_stats = await get_usage_report(user["user_id"])
     
     plan = None
     if user.get("plan_name"):
@@ -211,4 +206,59 @@ async def get_user_usage(
         "plan": plan,
         "total_usage": total_usage,
         "usage_by_endpoint": detailed_stats
-    } 
\ No newline at end of file
+    } 
+
+@router.get("/admission", summary="Admission control queue depth and shed counts")
+async def get_admission_stats(admin: dict = Depends(verify_admin)):
+    return admission_controller.stats()
+
+@router.get("/circuit-breaker", summary="Database circuit breaker state and journaled usage")
+async def get_circuit_breaker_stats(admin: dict = Depends(verify_admin)):
+    return {"breaker": breaker.stats(), "usage_journal": usage_journal.stats()}
+
+@router.get("/quota-leases", summary="Quota lease statistics for this node")
+async def get_quota_lease_stats(admin: dict = Depends(verify_admin)):
+    return lease_manager.stats()
+
+# Token Revocation
+@router.post("/tokens/revoke", summary="Revoke a single access token")
+async def revoke_token(body: TokenRevocation, admin: dict = Depends(verify_admin)):
+    try:
+        payload = jwt.decode(body.token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+
+    if not payload.get("jti"):
+        raise HTTPException(status_code=400, detail="Token has no jti; revoke the user's tokens instead")
+
+    await revocation_list.revoke_token(
+        payload["jti"], payload.get("sub"), datetime.utcfromtimestamp(payload["exp"])
+    )
+    return {"message": "Token revoked"}
+
+@router.post("/users/{username}/revoke-tokens", summary="Revoke all tokens issued to a user so far")
+async def revoke_user_tokens(
+    username: str = Path(..., description="The username whose tokens to revoke"),
+    admin: dict = Depends(verify_admin)
+):
+    user = await db.users.find_one({"username": username})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    await revocation_list.revoke_user(user["user_id"], timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    return {"message": "User tokens revoked"}
+
+@router.post("/tokens/revoke-before", summary="Revoke every token issued before a given time")
+async def revoke_tokens_before(body: RevokeBefore, admin: dict = Depends(verify_admin)):
+    await revocation_list.revoke_all(body.before, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    return {"message": "Tokens revoked", "revoked_before": body.before}
+
+@router.get("/tokens/revocations", summary="Revocation list statistics for this worker")
+async def get_revocation_stats(admin: dict = Depends(verify_admin)):
+    return revocation_list.stats()
+
+@router.get("/shared-counters", summary="Host-local shared quota counter statistics")
+async def get_shared_counter_stats(admin: dict = Depends(verify_admin)):
+    if not shared_counters:
+        return {"enabled": False}
+    return {"enabled": True, **shared_counters.stats()}
\ No newline at end of file
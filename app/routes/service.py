@@ -1,8 +1,70 @@
 from fastapi import APIRouter, Header, Depends, HTTPException
-from ..database import check_access
+import asyncio
+from ..database import check_access, check_access_batch
 from ..auth import get_current_user
+from ..admission import admit
+from ..models import BatchRequest
 
-router = APIRouter(prefix="/service", tags=["service"])
+router = APIRouter(prefix="/service", tags=["service"], dependencies=[Depends(admit)])
+
+MAX_BATCH_OPERATIONS = 50
+
+SERVICES = {
+    "/compute": ("Compute service accessed successfully", {
+        "job_id": "job-123456",
+        "status": "completed",
+        "result": "Computation complete"
+    }),
+    "/storage": ("Storage service accessed successfully", {
+        "files": ["file1.txt", "file2.jpg", "document.pdf"]
+    }),
+    "/ai": ("AI service accessed successfully", {
+        "models": ["text-generation", "image-recognition", "sentiment-analysis"]
+    }),
+    "/monitoring": ("Monitoring service accessed successfully", {
+        "status": "active",
+        "uptime": "99.99%",
+        "alerts": []
+    }),
+    "/security": ("Security service accessed successfully", {
+        "status": "secure",
+        "last_scan": "2023-05-15T14:30:00Z",
+        "threats_detected": 0
+    }),
+    "/networking": ("Networking service accessed successfully", {
+        "status": "connected",
+        "bandwidth": "10Gbps",
+        "latency": "5ms"
+    }),
+    "/analytics": ("Analytics service accessed successfully", {
+        "metrics": {
+            "visits": 1024,
+            "conversions": 128,
+            "bounce_rate": "25%"
+        }
+    }),
+    "/messaging": ("Messaging service accessed successfully", {
+        "messages": [
+            {"from": "system", "content": "Welcome to the messaging service!"},
+            {"from": "support", "content": "How can we help you today?"}
+        ]
+    }),
+}
+
+def service_endpoint(service: str) -> str:
+    # Accept "compute", "/compute" and "/service/compute"
+    name = service.strip("/")
+    if name.startswith("service/"):
+        name = name[len("service/"):]
+    return "/" + name
+
+async def invoke_service(endpoint: str, user: dict):
+    message, data = SERVICES[endpoint]
+    return {
+        "message": message,
+        "user": user["username"],
+        "data": data
+    }
 
 async def verify_endpoint_access(endpoint: str, user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], endpoint)
@@ -11,102 +73,76 @@ async def verify_endpoint_access(endpoint: str, user: dict = Depends(get_current
 @router.get("/compute", summary="Access compute service")
 async def compute_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/compute")
-    return {
-        "message": "Compute service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "job_id": "job-123456",
-            "status": "completed",
-            "result": "Computation complete"
-        }
-    }
+    return await invoke_service("/compute", user)
 
 @router.get("/storage", summary="Access storage service")
 async def storage_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/storage")
-    return {
-        "message": "Storage service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "files": ["file1.txt", "file2.jpg", "document.pdf"]
-        }
-    }
+    return await invoke_service("/storage", user)
 
 @router.get("/ai", summary="Access AI service")
 async def ai_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/ai")
-    return {
-        "message": "AI service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "models": ["text-generation", "image-recognition", "sentiment-analysis"]
-        }
-    }
+    return await invoke_service("/ai", user)
 
 @router.get("/monitoring", summary="Access monitoring service")
 async def monitoring_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/monitoring")
-    return {
-        "message": "Monitoring service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "status": "active",
-            "uptime": "99.99%",
-            "alerts": []
-        }
-    }
+    return await invoke_service("/monitoring", user)
 
 @router.get("/security", summary="Access security service")
 async def security_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/security")
-    return {
-        "message": "Security service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "status": "secure",
-            "last_scan": "2023-05-15T14:30:00Z",
-            "threats_detected": 0
-        }
-    }
+    return await invoke_service("/security", user)
 
 @router.get("/networking", summary="Access networking service")
 async def networking_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/networking")
-    return {
-        "message": "Networking service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "status": "connected",
-            "bandwidth": "10Gbps",
-            "latency": "5ms"
-        }
-    }
+    return await invoke_service("/networking", user)
 
 @router.get("/analytics", summary="Access analytics service")
 async def analytics_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/analytics")
-    return {
-        "message": "Analytics service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "metrics": {
-                "visits": 1024,
-                "conversions": 128,
-                "bounce_rate": "25%"
-            }
-        }
-    }
+    return await invoke_service("/analytics", user)
 
 @router.get("/messaging", summary="Access messaging service")
 async def messaging_service(user: dict = Depends(get_current_user)):
     await check_access(user["user_id"], "/messaging")
+    return await invoke_service("/messaging", user)
+
+@router.post("/batch", summary="Invoke several services in one request")
+async def batch_service(batch: BatchRequest, user: dict = Depends(get_current_user)):
+    if not batch.operations:
+        raise HTTPException(status_code=400, detail="No operations given")
+    if len(batch.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+
+    endpoints = [service_endpoint(op.service) for op in batch.operations]
+    errors = {
+        endpoint: HTTPException(status_code=404, detail="Service not found")
+        for endpoint in endpoints if endpoint not in SERVICES
+    }
+    known = [endpoint for endpoint in endpoints if endpoint in SERVICES]
+    if known and not (batch.atomic and errors):
+        errors.update(await check_access_batch(user, known, batch.atomic))
+
+    aborted = batch.atomic and any(errors.values())
+    allowed = [] if aborted else [endpoint for endpoint in endpoints if errors[endpoint] is None]
+    responses = iter(await asyncio.gather(*(invoke_service(endpoint, user) for endpoint in allowed)))
+
+    results = []
+    for endpoint in endpoints:
+        error = errors.get(endpoint)
+        if error:
+            results.append({"service": endpoint, "status_code": error.status_code, "detail": error.detail})
+        elif aborted:
+            results.append({"service": endpoint, "status_code": 424, "detail": "Batch aborted"})
+        else:
+            results.append({"service": endpoint, "status_code": 200, "response": next(responses)})
+
     return {
-        "message": "Messaging service accessed successfully",
-        "user": user["username"],
-        "data": {
-            "messages": [
-                {"from": "system", "content": "Welcome to the messaging service!"},
-                {"from": "support", "content": "How can we help you today?"}
-            ]
-        }
-    } 
\ No newline at end of file
+        "atomic": batch.atomic,
+        "succeeded": sum(1 for result in results if result["status_code"] == 200),
+        "failed": sum(1 for result in results if result["status_code"] != 200),
+        "results": results
+    }
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
 from ..models import SubscriptionDetails, User
-from ..database import subscribe_user, get_user_subscription, serialize_doc, db
+from ..database import subscribe_user, get_user_subscription, get_usage_report, serialize_doc, db
 from ..auth import get_current_user
 from typing import Optional
 
@@ -21,25 +21,7 @@ async def get_subscription_details(user: dict = Depends(get_current_user)):
     if isinstance(subscription["plan"], dict):
         subscription["plan"] = serialize_doc(subscription["plan"])
     
-    usage_stats = await db.usage.find({"user_id": user["user_id"]}).to_list(length=None)
-    
-    total_usage = 0
-    usage_by_endpoint = []
-    
-    for stat in usage_stats:
-        endpoint = stat.get("endpoint", "unknown")
-        count = stat.get("count", 0)
-        
-        permission = await db.permissions.find_one({"endpoint": endpoint})
-        permission_name = permission["name"] if permission else "unknown"
-        
-        usage_by_endpoint.append({
-            "endpoint": endpoint,
-            "permission_name": permission_name,
-            "count": count,
-            "last_access": stat.get("last_updated")
-        })
-        total_usage += count
+    total_usage, usage_by_endpoint = await get_usage_report(user["user_id"])
     
     subscription["usage"] = {
         "total": total_usage,
@@ -51,23 +33,8 @@ async def get_subscription_details(user: dict = Depends(get_current_user)):
 
 @router.get("/usage", summary="View your API usage statistics")
 async def get_my_usage(user: dict = Depends(get_current_user)):
-    usage_stats = await db.usage.find({"user_id": user["user_id"]}).to_list(length=None)
-    
-    detailed_stats = []
-    total_usage = 0
-    
-    for stat in usage_stats:
-        endpoint = stat.get("endpoint", "unknown")
-        permission = await db.permissions.find_one({"endpoint": endpoint})
-        
-        detailed_stat = {
-            "endpoint": endpoint,
-            "permission_name": permission["name"] if permission else "unknown",
-            "count": stat.get("count", 0),
-            "last_access": stat.get("last_updated", None)
-        }
-        detailed_stats.append(serialize_doc(detailed_stat))
-        total_usage += stat.get("count", 0)
+    total_usage, usage_by_endpoint = await get_usage_report(user["user_id"])
+    detailed_stats = [serialize_doc(stat) for stat in usage_by_endpoint]
     
     plan = None
     if user.get("plan_name"):
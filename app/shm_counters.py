@@ -0,0 +1,214 @@
+import mmap
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl; the module stays importable with the counters disabled
+    fcntl = None
+
+# Host-local quota counters shared by every worker process on the machine.
+# The table is a memory-mapped file of fixed-size slots split into stripes;
+# a key always probes within its own stripe, so one POSIX byte-range lock per
+# stripe makes lookups, inserts and increments atomic across processes.
+SHM_COUNTERS_ENABLED = os.getenv("SHM_COUNTERS_ENABLED", "false").lower() == "true"
+SHM_COUNTERS_PATH = os.getenv("SHM_COUNTERS_PATH", "/dev/shm/api_management_counters")
+SHM_COUNTERS_SLOTS = int(os.getenv("SHM_COUNTERS_SLOTS", "65536"))
+SHM_COUNTERS_STRIPES = int(os.getenv("SHM_COUNTERS_STRIPES", "256"))
+# Idle, fully synced counters are dropped after this long
+SHM_EVICT_SECONDS = float(os.getenv("SHM_EVICT_SECONDS", "300"))
+
+MAGIC = b"APIMSCTR"
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+# count, synced (value last written to the database), last access, key length
+SLOT = struct.Struct("<qqqH")
+SLOT_SIZE = 128
+MAX_KEY = SLOT_SIZE - SLOT.size
+EMPTY = 0
+TOMBSTONE = 0xFFFF
+
+
+class SharedCounters:
+    def __init__(
+        self,
+        path: str = SHM_COUNTERS_PATH,
+        slots: int = SHM_COUNTERS_SLOTS,
+        stripes: int = SHM_COUNTERS_STRIPES,
+    ):
+        if fcntl is None:
+            raise RuntimeError("Shared quota counters need POSIX file locks (fcntl), which this platform lacks")
+        if slots % stripes:
+            raise ValueError("SHM_COUNTERS_SLOTS must be a multiple of SHM_COUNTERS_STRIPES")
+        self.path = path
+        self.slots = slots
+        self.stripes = stripes
+        self.per_stripe = slots // stripes
+        # Lock bytes: one per stripe, then the syncer and initialisation locks
+        self._sync_lock = stripes
+        self._init_lock = stripes + 1
+        size = HEADER_SIZE + slots * SLOT_SIZE
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._init_lock)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, slots, stripes), 0)
+            magic, existing_slots, existing_stripes = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+            if (magic, existing_slots, existing_stripes) != (MAGIC, slots, stripes):
+                raise ValueError(f"{path} holds a counter table with a different layout")
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._init_lock)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _locked(self, stripe: int):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+    @staticmethod
+    def _key(user_id: str, endpoint: str) -> bytes:
+        return f"{user_id}\0{endpoint}".encode()
+
+    def _stripe(self, key: bytes) -> Tuple[int, int]:
+        h = zlib.crc32(key)
+        return h % self.stripes, (h // self.stripes) % self.per_stripe
+
+    def _find(self, key: bytes, stripe: int, start: int) -> Tuple[Optional[int], Optional[int]]:
+        # Returns (offset of the key's slot, offset of the first free slot)
+        mm = self._mm
+        base = HEADER_SIZE + stripe * self.per_stripe * SLOT_SIZE
+        free = None
+        for i in range(self.per_stripe):
+            offset = base + ((start + i) % self.per_stripe) * SLOT_SIZE
+            key_length = SLOT.unpack_from(mm, offset)[3]
+            if key_length == EMPTY:
+                return None, free if free is not None else offset
+            if key_length == TOMBSTONE:
+                if free is None:
+                    free = offset
+            elif key_length == len(key) and mm[offset + SLOT.size:offset + SLOT.size + key_length] == key:
+                return offset, None
+        return None, free
+
+    def consume(self, user_id: str, endpoint: str, limit: int, count: int = 1) -> Optional[bool]:
+        # Take `count` calls at once. True/False when the key is known on this
+        # host, None when it has to be seeded from the database first
+        key = self._key(user_id, endpoint)
+        if len(key) > MAX_KEY:
+            return None
+        stripe, start = self._stripe(key)
+        with self._locked(stripe):
+            offset, _ = self._find(key, stripe, start)
+            if offset is None:
+                return None
+            used, synced, _, key_length = SLOT.unpack_from(self._mm, offset)
+            if used + count > limit:
+                return False
+            SLOT.pack_into(self._mm, offset, used + count, synced, int(time.time()), key_length)
+            return True
+
+    def refund(self, user_id: str, endpoint: str, count: int):
+        # Give back calls taken by consume(). If they were synced already the
+        # next collect() returns a negative delta.
+        key = self._key(user_id, endpoint)
+        if len(key) > MAX_KEY:
+            return
+        stripe, start = self._stripe(key)
+        with self._locked(stripe):
+            offset, _ = self._find(key, stripe, start)
+            if offset is not None:
+                used, synced, touched, key_length = SLOT.unpack_from(self._mm, offset)
+                SLOT.pack_into(self._mm, offset, max(0, used - count), synced, touched, key_length)
+
+    def seed(self, user_id: str, endpoint: str, count: int) -> bool:
+        # Insert the database count unless another worker got there first
+        key = self._key(user_id, endpoint)
+        if len(key) > MAX_KEY:
+            return False
+        stripe, start = self._stripe(key)
+        with self._locked(stripe):
+            offset, free = self._find(key, stripe, start)
+            if offset is not None:
+                return True
+            if free is None:
+                return False
+            SLOT.pack_into(self._mm, free, count, count, int(time.time()), len(key))
+            self._mm[free + SLOT.size:free + SLOT.size + len(key)] = key
+            return True
+
+    def reset_user(self, user_id: str):
+        # The database counters were reset; drop this user's entries
+        prefix = f"{user_id}\0".encode()
+        position = self._mm.find(prefix, HEADER_SIZE)
+        while position != -1:
+            offset = position - SLOT.size
+            if offset >= HEADER_SIZE and (offset - HEADER_SIZE) % SLOT_SIZE == 0:
+                stripe = (offset - HEADER_SIZE) // (self.per_stripe * SLOT_SIZE)
+                with self._locked(stripe):
+                    key_length = SLOT.unpack_from(self._mm, offset)[3]
+                    if key_length not in (EMPTY, TOMBSTONE) and self._mm[position:position + len(prefix)] == prefix:
+                        SLOT.pack_into(self._mm, offset, 0, 0, 0, TOMBSTONE)
+            position = self._mm.find(prefix, position + 1)
+
+    def collect(self, evict_after: float = SHM_EVICT_SECONDS) -> Dict[Tuple[str, str], int]:
+        # Mark every unsynced delta as synced and return it; callers give it
+        # back with restore() if the database write fails
+        deltas = {}
+        idle_before = time.time() - evict_after
+        for stripe in range(self.stripes):
+            base = HEADER_SIZE + stripe * self.per_stripe * SLOT_SIZE
+            with self._locked(stripe):
+                for i in range(self.per_stripe):
+                    offset = base + i * SLOT_SIZE
+                    count, synced, touched, key_length = SLOT.unpack_from(self._mm, offset)
+                    if key_length in (EMPTY, TOMBSTONE):
+                        continue
+                    if count != synced:
+                        user_id, endpoint = bytes(self._mm[offset + SLOT.size:offset + SLOT.size + key_length]).decode().split("\0", 1)
+                        deltas[(user_id, endpoint)] = count - synced
+                        SLOT.pack_into(self._mm, offset, count, count, touched, key_length)
+                    elif touched < idle_before:
+                        SLOT.pack_into(self._mm, offset, 0, 0, 0, TOMBSTONE)
+        return deltas
+
+    def restore(self, user_id: str, endpoint: str, delta: int):
+        key = self._key(user_id, endpoint)
+        stripe, start = self._stripe(key)
+        with self._locked(stripe):
+            offset, _ = self._find(key, stripe, start)
+            if offset is not None:
+                count, synced, touched, key_length = SLOT.unpack_from(self._mm, offset)
+                SLOT.pack_into(self._mm, offset, count, synced - delta, touched, key_length)
+
+    def try_lock_sync(self) -> bool:
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self._sync_lock)
+        except OSError:
+            return False
+        return True
+
+    def unlock_sync(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._sync_lock)
+
+    def stats(self) -> dict:
+        used = unsynced = 0
+        for slot in range(self.slots):
+            count, synced, _, key_length = SLOT.unpack_from(self._mm, HEADER_SIZE + slot * SLOT_SIZE)
+            if key_length not in (EMPTY, TOMBSTONE):
+                used += 1
+                unsynced += count - synced
+        return {"path": self.path, "slots": self.slots, "used_slots": used, "unsynced_calls": unsynced}
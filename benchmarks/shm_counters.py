@@ -0,0 +1,109 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.shm_counters import SharedCounters
+
+# Several processes hammer the same shared counters while a syncer process
+# keeps collecting deltas, like the background sync in the API does. Checks
+# that every key admits exactly `limit` calls and that the synced deltas add
+# up to the admitted calls, then reports per-call latency.
+#
+#   python benchmarks/shm_counters.py --processes 8 --calls 200000
+
+def worker(path, slots, stripes, keys, limit, calls, results):
+    counters = SharedCounters(path, slots, stripes)
+    admitted = [0] * keys
+    start = time.perf_counter()
+    for i in range(calls):
+        key = i % keys
+        user_id, endpoint = f"user-{key}", "/compute"
+        allowed = counters.consume(user_id, endpoint, limit)
+        if allowed is None:
+            counters.seed(user_id, endpoint, 0)
+            allowed = counters.consume(user_id, endpoint, limit)
+        if allowed:
+            admitted[key] += 1
+    results.put((admitted, time.perf_counter() - start, calls))
+    counters.close()
+
+def syncer(path, slots, stripes, stop, results):
+    counters = SharedCounters(path, slots, stripes)
+    synced = {}
+    rounds = 0
+    while True:
+        finished = stop.is_set()
+        if counters.try_lock_sync():
+            for (user_id, _), delta in counters.collect(evict_after=3600).items():
+                synced[user_id] = synced.get(user_id, 0) + delta
+            counters.unlock_sync()
+            rounds += 1
+        if finished:
+            break
+        time.sleep(0.01)
+    results.put((synced, rounds))
+    counters.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process benchmark for the shared quota counters")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=100000, help="Calls per process")
+    parser.add_argument("--keys", type=int, default=64)
+    parser.add_argument("--limit", type=int, default=5000, help="Call limit per key")
+    parser.add_argument("--slots", type=int, default=65536)
+    parser.add_argument("--stripes", type=int, default=256)
+    args = parser.parse_args()
+
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    path = os.path.join(directory, f"api_management_counters_bench_{os.getpid()}")
+    SharedCounters(path, args.slots, args.stripes).close()
+
+    results = multiprocessing.Queue()
+    sync_results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    sync_process = multiprocessing.Process(target=syncer, args=(path, args.slots, args.stripes, stop, sync_results))
+    sync_process.start()
+    workers = [
+        multiprocessing.Process(target=worker, args=(path, args.slots, args.stripes, args.keys, args.limit, args.calls, results))
+        for _ in range(args.processes)
+    ]
+    started = time.perf_counter()
+    for process in workers:
+        process.start()
+    outcomes = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - started
+    for process in workers:
+        process.join()
+    stop.set()
+    synced, rounds = sync_results.get()
+    sync_process.join()
+    os.remove(path)
+
+    admitted = [sum(outcome[0][key] for outcome in outcomes) for key in range(args.keys)]
+    attempts_per_key = [
+        sum(len(range(key, args.calls, args.keys)) for _ in workers) for key in range(args.keys)
+    ]
+    expected = [min(args.limit, attempts) for attempts in attempts_per_key]
+    total_calls = args.calls * args.processes
+    per_call = sum(outcome[1] for outcome in outcomes) / total_calls
+
+    print(f"processes={args.processes} calls={total_calls} keys={args.keys} limit={args.limit}")
+    print(f"throughput={total_calls / elapsed:,.0f} calls/s  mean latency={per_call * 1e6:.2f} us/call")
+    print(f"admitted={sum(admitted)} expected={sum(expected)} sync rounds={rounds} synced={sum(synced.values())}")
+
+    errors = []
+    if admitted != expected:
+        errors.append("admitted calls per key do not match the limit")
+    if [synced.get(f"user-{key}", 0) for key in range(args.keys)] != admitted:
+        errors.append("synced deltas do not match admitted calls")
+    for error in errors:
+        print(f"FAILED: {error}")
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+from app import admission
+from app.admission import AdmissionController
+
+
+async def _queued(controller: AdmissionController, *args) -> asyncio.Task:
+    # Start acquire() in the background and let it reach the queue
+    task = asyncio.create_task(controller.acquire(*args))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_plan_cap_does_not_block_other_plans():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=4, min_concurrency=1, queue_timeout=1)
+        await controller.acquire("basic", 0, 1)
+        capped = await _queued(controller, "basic", 0, 1)
+        assert not capped.done()
+
+        # Another plan still fits under the global limit
+        await asyncio.wait_for(controller.acquire("pro", 0, None), 0.1)
+        assert controller.in_flight == 2
+
+        controller.release("basic", 0.0)
+        await asyncio.wait_for(capped, 0.1)
+        assert controller.stats()["in_flight_by_plan"] == {"basic": 1, "pro": 1}
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_admitted_by_priority():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, min_concurrency=1, queue_timeout=1)
+        await controller.acquire("free", 0)
+        low = await _queued(controller, "free", 0)
+        high = await _queued(controller, "pro", 10)
+
+        controller.release("free", 0.0)
+        await asyncio.wait_for(high, 0.1)
+        assert not low.done()
+
+        controller.release("pro", 0.0)
+        await asyncio.wait_for(low, 0.1)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_preempts_lower_priority_waiter():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, min_concurrency=1, queue_size=1, queue_timeout=1)
+        await controller.acquire("free", 0)
+        low = await _queued(controller, "free", 0)
+        high = await _queued(controller, "pro", 10)
+
+        with pytest.raises(HTTPException) as error:
+            await low
+        assert error.value.status_code == 503
+        assert "Retry-After" in error.value.headers
+
+        # Nothing queued has a lower priority than the newcomer
+        with pytest.raises(HTTPException):
+            await controller.acquire("free", 0)
+
+        controller.release("free", 0.0)
+        await asyncio.wait_for(high, 0.1)
+        assert controller.shed == {("free", "preempted"): 1, ("free", "queue_full"): 1}
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_sheds_waiter():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, min_concurrency=1, queue_timeout=0.05)
+        await controller.acquire("free", 0)
+
+        with pytest.raises(HTTPException) as error:
+            await controller.acquire("free", 0)
+        assert error.value.status_code == 503
+        assert controller.shed == {("free", "timeout"): 1}
+        assert controller.stats()["queue_depth"] == 0
+
+        controller.release("free", 0.0)
+        assert controller.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, min_concurrency=1, queue_timeout=1)
+        await controller.acquire("free", 0)
+        waiter = await _queued(controller, "free", 0)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        controller.release("free", 0.0)
+        assert controller.in_flight == 0
+        assert controller.stats()["queue_depth"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_limit_shrinks_on_slow_requests_and_grows_back(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_ADJUST_SECONDS", 0)
+    controller = AdmissionController(max_concurrency=10, min_concurrency=4, target_latency=0.1)
+
+    controller._observe(1.0)
+    assert controller.limit == pytest.approx(10 * admission.DECREASE_FACTOR)
+    for _ in range(10):
+        controller._observe(1.0)
+    assert controller.limit == 4
+
+    # Latency is smoothed, so it takes a few fast samples to fall below target
+    for _ in range(30):
+        controller._observe(0.001)
+    assert controller.limit == 10
+
+
+def test_plan_settings_come_from_cached_documents(monkeypatch):
+    cached = {
+        ("users", "u1"): {"user_id": "u1", "plan_name": "pro"},
+        ("plans", "pro"): {"name": "pro", "priority": 10, "max_concurrency": 3},
+    }
+
+    def peek_cached(collection, query):
+        return cached.get((collection, query.get("user_id") or query.get("name")))
+
+    monkeypatch.setattr(admission, "db", SimpleNamespace(users="users", plans="plans"))
+    monkeypatch.setattr(admission, "peek_cached", peek_cached)
+
+    assert admission._plan_settings("u1") == ("pro", 10, 3)
+    # Not seen yet: queued without plan priority instead of waiting on the database
+    assert admission._plan_settings("u2") == (None, 0, None)
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import pytest
+from app.quota_lease import QuotaLeaseManager
+
+
+class Outage(Exception):
+    pass
+
+
+class CentralCounter:
+    # Stands in for reserve_usage/release_usage on one usage document
+    def __init__(self):
+        self.count = 0
+        self.reserve_calls = 0
+        self.failing_releases = 0
+
+    async def reserve(self, user_id, endpoint, wanted, limit):
+        self.reserve_calls += 1
+        await asyncio.sleep(0)
+        granted = max(0, min(wanted, limit - self.count))
+        self.count += granted
+        return granted, "period"
+
+    async def release(self, user_id, endpoint, count, ref):
+        await asyncio.sleep(0)
+        if self.failing_releases:
+            self.failing_releases -= 1
+            raise Outage()
+        self.count -= count
+
+
+def _manager(counter, **kwargs):
+    kwargs.setdefault("ttl", 10)
+    kwargs.setdefault("min_block", 5)
+    return QuotaLeaseManager(counter.reserve, counter.release, enabled=True, **kwargs)
+
+
+def _expire(manager):
+    for lease in manager._leases.values():
+        lease.expires_at = time.monotonic() - 1
+
+
+def test_nodes_never_admit_more_than_the_limit():
+    async def scenario():
+        counter = CentralCounter()
+        nodes = [_manager(counter), _manager(counter)]
+        results = await asyncio.gather(*(nodes[i % 2].consume("u", "/compute", 23) for i in range(100)))
+        leased = sum(node.stats()["leased_calls"] for node in nodes)
+        assert counter.count == 23
+        assert sum(results) + leased == 23
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_returns_unspent_calls():
+    async def scenario():
+        counter = CentralCounter()
+        manager = _manager(counter)
+        assert await manager.consume("u", "/compute", 100)
+        assert counter.count == 5
+
+        _expire(manager)
+        await manager.release_expired()
+        assert counter.count == 1
+        assert manager.stats()["active_leases"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_exhausted_key_is_refused_without_a_reservation():
+    async def scenario():
+        counter = CentralCounter()
+        manager = _manager(counter, min_block=1)
+        assert await manager.consume("u", "/compute", 1)
+        assert not await manager.consume("u", "/compute", 1)
+        calls = counter.reserve_calls
+        assert not await manager.consume("u", "/compute", 1)
+        assert counter.reserve_calls == calls
+
+        manager.forget_user("u")
+        assert not await manager.consume("u", "/compute", 1)
+        assert counter.reserve_calls == calls + 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_release_keeps_lease_and_returns_other_keys():
+    async def scenario():
+        counter = CentralCounter()
+        manager = _manager(counter)
+        await manager.consume("u", "/compute", 100)
+        await manager.consume("u", "/storage", 100)
+        _expire(manager)
+
+        counter.failing_releases = 1
+        await manager.release_expired()
+        assert counter.count == 6
+        assert manager.stats()["active_leases"] == 1
+        assert manager.stats()["failed_releases"] == 1
+
+        await manager.release_expired()
+        assert counter.count == 2
+        assert manager.stats()["active_leases"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_failed_release_on_refill_keeps_the_old_lease():
+    async def scenario():
+        counter = CentralCounter()
+        manager = _manager(counter)
+        await manager.consume("u", "/compute", 100)
+        _expire(manager)
+
+        counter.failing_releases = 1
+        with pytest.raises(Outage):
+            await manager.consume("u", "/compute", 100)
+        assert manager.stats()["leased_calls"] == 4
+
+        await manager.release_expired()
+        assert counter.count == 1
+
+    asyncio.run(scenario())
+
+
+def test_stop_finishes_when_releases_fail():
+    async def scenario():
+        counter = CentralCounter()
+        manager = _manager(counter)
+        manager.start()
+        await manager.consume("u", "/compute", 100)
+
+        counter.failing_releases = 1
+        await manager.stop()
+        assert manager._sweeper is None
+        assert manager.stats()["failed_releases"] == 1
+
+    asyncio.run(scenario())
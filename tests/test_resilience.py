@@ -0,0 +1,206 @@
+import asyncio
+import json
+import os
+import pytest
+from pymongo.errors import AutoReconnect, DuplicateKeyError, ServerSelectionTimeoutError
+from app import resilience
+from app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, DatabaseUnavailable, UsageJournal
+
+
+async def _fail(error):
+    raise error
+
+
+async def _ok():
+    return "ok"
+
+
+def _tripped_breaker(**kwargs) -> CircuitBreaker:
+    # Open, with the reset timeout already over: the next call is a probe
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0, **kwargs)
+    breaker._trip()
+    return breaker
+
+
+def test_breaker_opens_after_threshold_and_rejects():
+    async def scenario():
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with pytest.raises(DatabaseUnavailable):
+                await breaker.call(lambda: _fail(AutoReconnect("down")))
+        assert breaker.state == OPEN
+
+        with pytest.raises(DatabaseUnavailable) as error:
+            await breaker.call(_ok)
+        assert error.value.not_sent
+        assert breaker.rejected == 1
+
+    asyncio.run(scenario())
+
+
+def test_half_open_probe_closes_or_reopens():
+    breaker = _tripped_breaker()
+    assert asyncio.run(breaker.call(_ok)) == "ok"
+    assert breaker.state == CLOSED
+
+    breaker = _tripped_breaker()
+    with pytest.raises(DatabaseUnavailable):
+        asyncio.run(breaker.call(lambda: _fail(AutoReconnect("still down"))))
+    assert breaker.state == OPEN
+
+
+def test_half_open_allows_a_single_probe():
+    async def scenario():
+        breaker = _tripped_breaker(half_open_probes=1)
+        probe = asyncio.create_task(breaker.call(lambda: asyncio.sleep(0.05)))
+        await asyncio.sleep(0)
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(DatabaseUnavailable):
+            await breaker.call(_ok)
+        await probe
+        assert breaker.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_frees_the_probe_slot():
+    async def scenario():
+        breaker = _tripped_breaker(half_open_probes=1)
+        probe = asyncio.create_task(breaker.call(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert await breaker.call(_ok) == "ok"
+        assert breaker.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_query_errors_pass_through_and_close_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=2)
+    with pytest.raises(DatabaseUnavailable):
+        asyncio.run(breaker.call(lambda: _fail(AutoReconnect("down"))))
+    with pytest.raises(DuplicateKeyError):
+        asyncio.run(breaker.call(lambda: _fail(DuplicateKeyError("dup"))))
+    assert breaker.failures == 0
+    assert breaker.state == CLOSED
+
+
+def test_only_unsent_operations_are_marked_not_sent():
+    breaker = CircuitBreaker(failure_threshold=10, call_timeout=0.01)
+    with pytest.raises(DatabaseUnavailable) as error:
+        asyncio.run(breaker.call(lambda: _fail(ServerSelectionTimeoutError("no server"))))
+    assert error.value.not_sent
+    with pytest.raises(DatabaseUnavailable) as error:
+        asyncio.run(breaker.call(lambda: asyncio.sleep(1)))
+    assert not error.value.not_sent
+
+
+class FakeUsage:
+    def __init__(self):
+        self.counts = {}
+        # Outcome of the next apply() calls: an exception to raise, or None
+        self.failures = []
+
+    async def apply(self, user_id, endpoint, count):
+        error = self.failures.pop(0) if self.failures else None
+        if error:
+            raise error
+        self.counts[(user_id, endpoint)] = self.counts.get((user_id, endpoint), 0) + count
+
+
+def _journal(tmp_path, usage) -> UsageJournal:
+    return UsageJournal(usage.apply, str(tmp_path / "usage_journal"))
+
+
+def _write(path, entries):
+    with open(path, "w") as journal:
+        for user_id, endpoint, count in entries:
+            journal.write(json.dumps({"user_id": user_id, "endpoint": endpoint, "count": count}) + "\n")
+
+
+def test_replay_applies_journaled_usage_once(tmp_path):
+    usage = FakeUsage()
+    journal = _journal(tmp_path, usage)
+    journal.record("u", "/compute")
+    journal.record("u", "/compute")
+    journal.record("u", "/storage")
+    assert journal.pending_count("u", "/compute") == 2
+
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 2, ("u", "/storage"): 1}
+    assert journal.pending_count("u", "/compute") == 0
+    assert os.listdir(tmp_path) == []
+
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 2, ("u", "/storage"): 1}
+
+
+def test_interrupted_replay_keeps_only_what_is_left(tmp_path):
+    usage = FakeUsage()
+    journal = _journal(tmp_path, usage)
+    journal.record("u", "/compute")
+    journal.record("u", "/storage")
+
+    # The second key hits an unexpected error, not an outage
+    usage.failures = [None, RuntimeError("boom")]
+    with pytest.raises(RuntimeError):
+        asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 1}
+
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 1, ("u", "/storage"): 1}
+
+
+def test_outage_during_replay_keeps_unsent_entries(tmp_path):
+    usage = FakeUsage()
+    journal = _journal(tmp_path, usage)
+    journal.record("u", "/compute")
+    usage.failures = [DatabaseUnavailable("open", not_sent=True)]
+
+    assert not asyncio.run(journal.replay())
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 1}
+
+
+def test_possibly_applied_entry_is_not_replayed_again(tmp_path):
+    usage = FakeUsage()
+    journal = _journal(tmp_path, usage)
+    journal.record("u", "/compute")
+    usage.failures = [DatabaseUnavailable("timeout")]
+
+    assert not asyncio.run(journal.replay())
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {}
+
+
+def test_orphaned_journals_are_claimed_and_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(resilience, "_process_alive", lambda pid: False)
+    usage = FakeUsage()
+    base = tmp_path / "usage_journal"
+    _write(f"{base}.4242", [("u", "/compute", 2)])
+    _write(f"{base}.4242.replaying", [("u", "/compute", 3)])
+
+    journal = _journal(tmp_path, usage)
+    usage.failures = [DatabaseUnavailable("open", not_sent=True)]
+    asyncio.run(journal.replay_orphans())
+    # Claimed under this worker's pid, so no other worker picks them up
+    assert all(name.startswith(f"usage_journal.{os.getpid()}.") for name in os.listdir(tmp_path))
+
+    assert asyncio.run(journal.replay())
+    assert usage.counts == {("u", "/compute"): 5}
+    assert os.listdir(tmp_path) == []
+
+
+def test_orphan_claimed_by_another_worker_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(resilience, "_process_alive", lambda pid: False)
+    base = str(tmp_path / "usage_journal")
+    real_glob = resilience.glob.glob
+    # Listed, but renamed away by another worker before this one gets to it
+    monkeypatch.setattr(resilience.glob, "glob", lambda pattern: [f"{base}.4242"] if pattern == f"{base}.*" else real_glob(pattern))
+
+    usage = FakeUsage()
+    asyncio.run(_journal(tmp_path, usage).replay_orphans())
+    assert usage.counts == {}
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import pytest
+from app import revocation
+from app.revocation import BloomFilter, RevocationList, to_timestamp
+
+LIFETIME = timedelta(minutes=30)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+
+@pytest.fixture
+def revocations(monkeypatch):
+    monkeypatch.setattr(revocation, "db", SimpleNamespace(revoked_tokens=FakeCollection()))
+    return RevocationList()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(bits=1024, hashes=3)
+    items = [f"token-{i}" for i in range(100)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+
+
+def test_revoked_token_only_matches_its_jti(revocations):
+    expires = datetime.utcnow() + LIFETIME
+    asyncio.run(revocations.revoke_token("abc", "user-1", expires))
+    assert revocations.is_revoked("abc", "user-1", to_timestamp(datetime.utcnow()))
+    assert not revocations.is_revoked("abd", "user-1", to_timestamp(datetime.utcnow()))
+    assert not revocations.is_revoked(None, "user-1", to_timestamp(datetime.utcnow()))
+
+
+def test_user_cutoff_within_the_same_second(revocations):
+    cutoff = datetime(2026, 10, 19, 12, 0, 0, 500000)
+    asyncio.run(revocations.revoke_user("user-1", LIFETIME, cutoff))
+
+    # Issued earlier in the cutoff's own second: revoked
+    assert revocations.is_revoked("a", "user-1", to_timestamp(cutoff) - 0.4)
+    # Re-login later in the same second: still valid
+    assert not revocations.is_revoked("b", "user-1", to_timestamp(cutoff) + 0.1)
+    assert not revocations.is_revoked("c", "user-2", to_timestamp(cutoff) - 0.4)
+
+
+def test_legacy_whole_second_iat_before_cutoff_is_revoked(revocations):
+    cutoff = datetime(2026, 10, 19, 12, 0, 0, 500000)
+    asyncio.run(revocations.revoke_user("user-1", LIFETIME, cutoff))
+    assert revocations.is_revoked("a", "user-1", float(int(to_timestamp(cutoff))))
+
+
+def test_cutoff_survives_millisecond_storage(revocations):
+    cutoff = datetime(2026, 10, 19, 12, 0, 0, 500400)
+    asyncio.run(revocations.revoke_user("user-1", LIFETIME, cutoff))
+
+    # Another worker reads the document back at Mongo's millisecond precision
+    stored = revocation.db.revoked_tokens.docs[-1]
+    assert stored["revoked_before"].microsecond % 1000 == 0
+    other = RevocationList()
+    other._apply(stored)
+    assert other.is_revoked("a", "user-1", to_timestamp(cutoff) - 0.0001)
+
+
+def test_revoke_before_keeps_sub_second_precision(revocations):
+    before = datetime(2026, 10, 19, 12, 0, 0, 500000, tzinfo=timezone.utc)
+    asyncio.run(revocations.revoke_all(before, LIFETIME))
+    assert revocations.is_revoked("a", "anyone", to_timestamp(before) - 0.5)
+    assert not revocations.is_revoked("b", "anyone", to_timestamp(before) + 0.001)
+
+
+def test_expired_cutoffs_are_pruned(revocations):
+    cutoff = datetime.utcnow() - 2 * LIFETIME
+    asyncio.run(revocations.revoke_user("user-1", LIFETIME, cutoff))
+    assert revocations.is_revoked("a", "user-1", to_timestamp(cutoff) - 1)
+
+    revocations._prune(to_timestamp(datetime.utcnow()))
+    assert not revocations.is_revoked("a", "user-1", to_timestamp(cutoff) - 1)